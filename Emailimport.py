@@ -1,78 +1,223 @@
 import imaplib
-import email
-from email.header import decode_header
+import re
+import uuid
 from qdrant_client import QdrantClient
+from qdrant_client.http.models import Batch, Distance, VectorParams
 import tkinter as tk
 from tkinter import messagebox
 import time
-import cohere  # Cohere SDK
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
+from chunking import CHUNK_OVERLAP, CHUNK_SIZE, chunk_text
+from email_parsing import parse_emails
+from embeddings import CohereBackend, embed_batches, get_embedding_backend
+from qdrant_store import UPSERT_WORKERS, check_vector_size, iter_batches, upsert_batches
+from sync_state import load_sync_state, save_sync_state
+from tracing import in_current_context, span
 load_dotenv()
-# Initialize Cohere client (replace 'your-api-key' with your actual API key)
-co = cohere.Client(os.getenv('COHERE_API_KEY'))
+# Embedding backend for emails (Cohere by default, reads COHERE_API_KEY)
+EMAIL_EMBEDDING_BACKEND = os.getenv('EMAIL_EMBEDDING_BACKEND', CohereBackend.name)
+# Maximum number of embedding requests in flight at once
+EMAIL_EMBED_WORKERS = int(os.getenv('EMAIL_EMBED_WORKERS', 4))
+# Messages requested per IMAP FETCH command
+FETCH_CHUNK_SIZE = 500
+# Last synced UID, UIDVALIDITY and embedding settings per account/label
+SYNC_STATE_FILE = os.getenv('EMAIL_SYNC_STATE_FILE', 'email_sync_state.json')
+EMAIL_COLLECTION = "emails"
+# Points per upsert request; a batch closes at the first email boundary past this
+EMAIL_UPSERT_BATCH_SIZE = 256
+EMAIL_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "imap://emails/")
+
+UID_RE = re.compile(rb"UID (\d+)")
+
+def sync_state_key(email_user, label):
+    return f"{email_user}/{label}"
+
+def email_settings(embedder, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Describe how the email points are built; a change re-embeds the whole mailbox"""
+    return f"{embedder.cache_key};chunks={chunk_size}/{chunk_overlap}"
+
+def get_uid_validity(mail):
+    """UIDVALIDITY reported by the last SELECT"""
+    result, data = mail.response('UIDVALIDITY')
+    return int(data[0])
 
 # Step 1: Connect to email via IMAP
-def get_emails(server, email_user, email_pass, label="INBOX", batch_size=10000):
+def get_emails(server, email_user, email_pass, label="INBOX", sync_state=None,
+               fetch_chunk_size=FETCH_CHUNK_SIZE, max_bytes=None, settings=None):
+    """Yield (uid, raw RFC822 bytes) for every message newer than the synced high-water mark.
+
+    sync_state maps sync_state_key(email_user, label) to the UIDVALIDITY,
+    last synced UID and embedding settings. If the server's UIDVALIDITY
+    differs from the stored one, UIDs were reassigned, and if settings
+    differ, the stored vectors came from another model; either way the
+    whole mailbox is rescanned. The entry is (re)initialised here; callers
+    advance last_uid once messages are stored.
+    """
     try:
         mail = imaplib.IMAP4_SSL(server)
         mail.login(email_user, email_pass)
-        mail.select(label)
-        
-        # Fetch email IDs
-        result, data = mail.search(None, 'ALL')
-        email_ids = data[0].split()
-        
-        # Fetch emails in batches
-        for i in range(0, len(email_ids), batch_size):
-            batch = email_ids[i:i + batch_size]
-            emails = []
-            for e_id in batch:
-                result, msg_data = mail.fetch(e_id, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        emails.append(msg)
-            yield emails
+        mail.select(label, readonly=True)
+
+        since_uid = 0
+        if sync_state is not None:
+            key = sync_state_key(email_user, label)
+            uid_validity = get_uid_validity(mail)
+            previous = sync_state.get(key)
+            if previous and previous["uidvalidity"] == uid_validity and previous.get("settings") == settings:
+                since_uid = previous["last_uid"]
+            elif previous and previous["uidvalidity"] != uid_validity:
+                print(f"UIDVALIDITY changed for {key}, rescanning the whole mailbox")
+            elif previous:
+                print(f"Embedding settings changed for {key}, re-embedding the whole mailbox")
+            sync_state[key] = {"uidvalidity": uid_validity, "last_uid": since_uid, "settings": settings}
+
+        yield from iter_mailbox_messages(mail, since_uid, fetch_chunk_size, max_bytes)
 
         mail.logout()
     except Exception as e:
         messagebox.showerror("Error", f"Failed to fetch emails: {str(e)}")
 
-# Step 2: Process and Vectorize emails using Cohere
-def process_emails(emails):
-    vectors = []
-    for msg in emails:
-        subject = decode_header(msg["subject"])[0][0]
-        if isinstance(subject, bytes):
-            subject = subject.decode()
-        # Get email body
-        body = get_email_body(msg)
-        email_text = f"Subject: {subject}\nBody: {body}"
-        
-        # Vectorize using Cohere
-        embedding = co.embed(texts=[email_text]).embeddings[0]
-        vectors.append(embedding)
-    return vectors
-
-def get_email_body(msg):
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                return part.get_payload(decode=True).decode()
-    else:
-        return msg.get_payload(decode=True).decode()
-
-# Step 3: Store in Qdrant
-def store_in_qdrant(vectors, client, batch_size=10000):
-    collection_name = "emails"
-    for i in range(0, len(vectors), batch_size):
-        batch_vectors = vectors[i:i + batch_size]
-        client.insert(
+def iter_mailbox_messages(mail, since_uid=0, fetch_chunk_size=FETCH_CHUNK_SIZE, max_bytes=None):
+    """Yield (uid, raw RFC822 bytes) in UID order for messages with a UID above since_uid.
+
+    Uses UID SEARCH UID n:* and ranged UID FETCH commands covering up to
+    fetch_chunk_size messages each. The next chunk is fetched in the
+    background while the current one is consumed. With max_bytes
+    set only the first max_bytes of each message are downloaded.
+    """
+    result, data = mail.uid('SEARCH', None, f'UID {since_uid + 1}:*')
+    # n:* always matches the highest UID, even when it is below n
+    email_ids = sorted((uid for uid in data[0].split() if int(uid) > since_uid), key=int)
+    chunks = [email_ids[i:i + fetch_chunk_size] for i in range(0, len(email_ids), fetch_chunk_size)]
+    if not chunks:
+        return
+    section = f"BODY.PEEK[]<0.{max_bytes}>" if max_bytes else "BODY.PEEK[]"
+
+    def fetch_chunk(chunk):
+        with span("email.fetch_chunk", messages=len(chunk)) as chunk_span:
+            result, msg_data = mail.uid('FETCH', to_message_set(chunk), f"(UID {section})")
+            messages = parse_fetch_response(msg_data)
+            chunk_span.set_attribute("bytes", sum(len(raw) for _, raw in messages))
+            return messages
+
+    fetch_chunk = in_current_context(fetch_chunk)
+
+    # One worker: imaplib connections must not be used from two threads at once
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_chunk, chunks[0])
+        for next_chunk in chunks[1:] + [None]:
+            raw_messages = future.result()
+            future = executor.submit(fetch_chunk, next_chunk) if next_chunk else None
+            yield from raw_messages
+
+def parse_fetch_response(msg_data):
+    """(uid, raw bytes) for each message in an imaplib UID FETCH response.
+
+    Servers may send the UID before or after the literal, so it is looked
+    for in the header of each (header, literal) tuple and, failing that, in
+    the closing fragment that follows it.
+    """
+    messages = []
+    for i, part in enumerate(msg_data):
+        if not isinstance(part, tuple):
+            continue
+        match = UID_RE.search(part[0])
+        if match is None and i + 1 < len(msg_data) and isinstance(msg_data[i + 1], bytes):
+            match = UID_RE.search(msg_data[i + 1])
+        if match is None:
+            raise ValueError(f"No UID in FETCH response {part[0][:100]!r}")
+        messages.append((int(match.group(1)), part[1]))
+    return messages
+
+def to_message_set(ids):
+    """Compress message numbers or UIDs into an IMAP message set such as 1:3,7"""
+    numbers = sorted(int(i) for i in ids)
+    ranges = []
+    start = prev = numbers[0]
+    for n in numbers[1:] + [None]:
+        if n is not None and n == prev + 1:
+            prev = n
+            continue
+        ranges.append(f"{start}:{prev}" if start != prev else f"{start}")
+        start = prev = n
+    return ",".join(ranges)
+
+# Step 2: Chunk, embed and store in Qdrant
+def ensure_email_collection(client, vector_size, collection_name=EMAIL_COLLECTION):
+    """Create the emails collection with the embedder's dimension if it is missing"""
+    collections = client.get_collections().collections
+    if not any(c.name == collection_name for c in collections):
+        client.create_collection(
             collection_name=collection_name,
-            vectors=batch_vectors,
-            payload=[{"email_id": i} for i in range(len(batch_vectors))]
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
         )
+    else:
+        check_vector_size(collection_name, client.get_collection(collection_name).config.params.vectors, vector_size)
+
+def email_point_id(parsed, fallback_key, chunk_index=0):
+    """Stable point ID from the Message-ID header, or fallback_key when it is missing.
+
+    The first chunk keeps the ID a whole email had before emails were chunked.
+    """
+    key = parsed["message_id"] or fallback_key
+    if chunk_index:
+        key = f"{key}#{chunk_index}"
+    return str(uuid.uuid5(EMAIL_ID_NAMESPACE, key))
+
+def email_payload(uid, parsed, chunk_index=0, text=None):
+    return {
+        "uid": uid,
+        "message_id": parsed["message_id"],
+        "subject": parsed["subject"],
+        "from": parsed["from"],
+        "date": parsed["date"],
+        "chunk_index": chunk_index,
+        "text": text,
+    }
+
+def iter_email_chunks(emails):
+    """Yield (uid, parsed, chunk_index, text) for every chunk of a stream of (uid, parsed email) pairs"""
+    for uid, parsed in emails:
+        for chunk_index, text in enumerate(chunk_text(parsed["text"])):
+            yield uid, parsed, chunk_index, text
+
+def build_email_batches(emails, embedder, fallback_key, batch_size=EMAIL_UPSERT_BATCH_SIZE,
+                        workers=EMAIL_EMBED_WORKERS):
+    """Chunk and embed a stream of (uid, parsed email) pairs into Batches of about batch_size points.
+
+    Chunks are embedded in API-sized batches on one worker pool for the
+    whole stream, then regrouped: a Batch closes at the first email
+    boundary once it holds batch_size points. All chunks of an email land
+    in the same Batch, so a stored batch never holds half an email and its
+    highest UID is a safe resume point; only a single email longer than
+    batch_size chunks makes a bigger one.
+    """
+    chunk_batches = iter_batches(iter_email_chunks(emails), embedder.batch_size)
+    group, last_uid = [], None
+    for chunks, vectors in embed_batches(embedder, chunk_batches, lambda chunk: chunk[3], workers):
+        for chunk, vector in zip(chunks, vectors.tolist()):
+            uid = chunk[0]
+            if uid != last_uid and len(group) >= batch_size:
+                yield email_batch(group, fallback_key)
+                group = []
+            group.append((chunk, vector))
+            last_uid = uid
+    if group:
+        yield email_batch(group, fallback_key)
+
+def email_batch(group, fallback_key):
+    """Batch of the (chunk, vector) pairs of whole emails"""
+    return Batch(
+        ids=[email_point_id(parsed, fallback_key(uid), chunk_index) for (uid, parsed, chunk_index, _), _ in group],
+        vectors=[vector for _, vector in group],
+        payloads=[email_payload(uid, parsed, chunk_index, text) for (uid, parsed, chunk_index, text), _ in group]
+    )
+
+def store_in_qdrant(email_batches, client, on_stored=None, workers=UPSERT_WORKERS):
+    """Stream email batches into the emails collection; uploads overlap with embedding"""
+    return upsert_batches(client, EMAIL_COLLECTION, email_batches, workers, on_stored)
 
 # Mapping of email providers to their IMAP servers
 EMAIL_SERVERS = {
@@ -92,20 +237,30 @@ def start_processing(email_user, email_pass, selected_server):
         )
 
         server = EMAIL_SERVERS[selected_server]  # Get the IMAP server based on user selection
-        batch_size = 20000  # Adjust based on your needs
-
-        # Process the emails in batches
-        for emails_batch in get_emails(server, email_user, email_pass, batch_size=batch_size):
-            start_time = time.time()
-            print(f"Processing {len(emails_batch)} emails...")
-            
-            # Step 2: Preprocess and Vectorize emails
-            vectors = process_emails(emails_batch)
-            
-            # Step 3: Store the vectors in Qdrant
-            store_in_qdrant(vectors, client, batch_size=batch_size)
-            
-            print(f"Batch processed and stored in {(time.time() - start_time) / 60:.2f} minutes.")
+        embedder = get_embedding_backend(EMAIL_EMBEDDING_BACKEND)
+        ensure_email_collection(client, embedder.size)
+
+        # Only messages newer than the last synced UID are fetched
+        sync_state = load_sync_state(SYNC_STATE_FILE)
+        state_key = sync_state_key(email_user, "INBOX")
+
+        def fallback_key(uid):
+            return f"{state_key}/{sync_state[state_key]['uidvalidity']}/{uid}"
+
+        def on_stored(batch):
+            # Batches complete in order, so this is a safe resume point
+            sync_state[state_key]["last_uid"] = max(payload["uid"] for payload in batch.payloads)
+            save_sync_state(sync_state, SYNC_STATE_FILE)
+
+        # Fetching, parsing (on a process pool), embedding and uploading all overlap
+        start_time = time.time()
+        with span("email.sync", server=server, label="INBOX") as sync_span:
+            emails = parse_emails(get_emails(
+                server, email_user, email_pass, sync_state=sync_state, settings=email_settings(embedder)
+            ))
+            stored = store_in_qdrant(build_email_batches(emails, embedder, fallback_key), client, on_stored)
+            sync_span.set_attribute("chunks", stored)
+        print(f"{stored} email chunks processed and stored in {(time.time() - start_time) / 60:.2f} minutes.")
         
         messagebox.showinfo("Success", "Emails processed and stored successfully.")
     except Exception as e:
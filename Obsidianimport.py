@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import uuid
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import Batch, Distance, VectorParams
+from dotenv import load_dotenv
+from chunking import CHUNK_OVERLAP, CHUNK_SIZE, chunk_text
+from embeddings import EMBED_WORKERS, embed_batches, get_embedding_backend
+from obsidian_source import diff_vault, note_payload, note_text, parse_note
+from qdrant_store import (
+    UPSERT_BATCH_SIZE, UPSERT_WORKERS, StaleChunks, check_vector_size, delete_file_points, delete_stale_chunks,
+    ensure_file_id_index, iter_batches, upsert_batches
+)
+from sync_state import load_sync_state, save_sync_state
+
+load_dotenv()
+OBSIDIAN_VAULT = os.getenv('OBSIDIAN_VAULT')
+OBSIDIAN_COLLECTION = os.getenv('OBSIDIAN_COLLECTION', 'obsidian')
+# Per collection and vault: the index settings and path -> [mtime_ns, size, hash] of every note
+MANIFEST_FILE = os.getenv('OBSIDIAN_MANIFEST_FILE', 'obsidian_manifest.json')
+NOTE_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "obsidian://notes/")
+
+
+def manifest_key(collection_name, vault):
+    return f"{collection_name}:{os.path.abspath(vault)}"
+
+
+def note_settings(embedder, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Describe how the notes' points are built; a change re-embeds the whole vault"""
+    return f"{embedder.cache_key};chunks={chunk_size}/{chunk_overlap}"
+
+
+def note_point_id(path, chunk_index):
+    """Deterministic point ID for a chunk of the note at a vault path"""
+    return str(uuid.uuid5(NOTE_ID_NAMESPACE, f"{path}#{chunk_index}"))
+
+
+def ensure_note_collection(client, collection_name, vector_size):
+    """Create the notes collection if it is missing, and its file_id index"""
+    collections = client.get_collections().collections
+    if not any(c.name == collection_name for c in collections):
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
+        )
+    else:
+        check_vector_size(collection_name, client.get_collection(collection_name).config.params.vectors, vector_size)
+    ensure_file_id_index(client, collection_name)
+
+
+def iter_note_chunks(changed, stale_chunks=None, new_paths=()):
+    """Yield (note, chunk_index, text) for changed notes.
+
+    Notes not in new_paths already have points, so their chunk counts are
+    tracked in stale_chunks to delete any chunks they no longer have.
+    """
+    for path, raw in changed:
+        note = parse_note(path, raw)
+        texts = list(chunk_text(note_text(note)))
+        if stale_chunks is not None and path not in new_paths:
+            stale_chunks.track(path, len(texts))
+        for chunk_index, text in enumerate(texts):
+            yield note, chunk_index, text
+
+
+def build_note_batches(changed, embedder, stale_chunks=None, new_paths=(),
+                       batch_size=UPSERT_BATCH_SIZE, workers=EMBED_WORKERS):
+    """Lazily chunk and embed changed notes into batches of at most batch_size points"""
+    chunks = iter_note_chunks(changed, stale_chunks, new_paths)
+    for batch, vectors in embed_batches(embedder, iter_batches(chunks, batch_size), lambda chunk: chunk[2], workers):
+        yield Batch(
+            ids=[note_point_id(note["path"], chunk_index) for note, chunk_index, _ in batch],
+            vectors=vectors.tolist(),
+            payloads=[note_payload(note, chunk_index, text) for note, chunk_index, text in batch]
+        )
+
+
+def sync_vault(vault, client, collection_name=OBSIDIAN_COLLECTION, embedder=None, manifest_file=MANIFEST_FILE):
+    """Bring a collection in line with a vault, touching only notes changed since the last run.
+
+    Returns (changed notes, removed notes, points written). When nothing
+    changed, Qdrant is not contacted at all. If the vault was indexed with
+    another embedding model or chunk settings, every note is re-embedded.
+    """
+    embedder = embedder or get_embedding_backend()
+    settings = note_settings(embedder)
+    manifests = load_sync_state(manifest_file)
+    key = manifest_key(collection_name, vault)
+    stored = manifests.get(key, {})
+    old_manifest = stored.get("notes", {})
+    if stored.get("settings") == settings:
+        changed, removed, manifest = diff_vault(vault, old_manifest)
+    else:
+        # Every note counts as changed, while removals are still found from the old manifest
+        changed, _, manifest = diff_vault(vault, {})
+        removed = [path for path in old_manifest if path not in manifest]
+    if changed or removed:
+        ensure_note_collection(client, collection_name, embedder.size)
+        stale_chunks = StaleChunks()
+        new_paths = {path for path, _ in changed if path not in old_manifest}
+        upserted = upsert_batches(
+            client, collection_name,
+            build_note_batches(changed, embedder, stale_chunks, new_paths),
+            UPSERT_WORKERS,
+            # A shortened note's leftover chunks go once its new ones are stored
+            on_stored=lambda batch: delete_stale_chunks(client, collection_name, stale_chunks.finished(batch))
+        )
+        delete_file_points(client, collection_name, removed)
+    else:
+        upserted = 0
+    if manifest != old_manifest or settings != stored.get("settings"):
+        manifests[key] = {"settings": settings, "notes": manifest}
+        save_sync_state(manifests, manifest_file)
+    return len(changed), len(removed), upserted
+
+
+if __name__ == "__main__":
+    vault = sys.argv[1] if len(sys.argv) > 1 else OBSIDIAN_VAULT
+    if not vault:
+        sys.exit("Usage: python Obsidianimport.py <vault directory>, or set OBSIDIAN_VAULT")
+    client = QdrantClient(
+        url=os.getenv('QDRANT_URL'),
+        api_key=os.getenv('QDRANT_API_KEY')
+    )
+    start_time = time.time()
+    changed, removed, upserted = sync_vault(vault, client)
+    print(
+        f"Obsidian sync completed in {time.time() - start_time:.2f}s: "
+        f"{changed} notes added or changed ({upserted} chunks), {removed} removed."
+    )
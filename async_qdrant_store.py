@@ -0,0 +1,323 @@
+# AsyncQdrantClient counterparts of the qdrant_store helpers, for the FastAPI apps.
+# Constants, point IDs and classification logic are shared with qdrant_store.
+import asyncio
+import inspect
+import time
+from collections import deque
+from qdrant_client.http.models import (
+    Distance, FieldCondition, Filter, FilterSelector, MatchAny, PayloadSchemaType, PointIdsList, VectorParams
+)
+from metrics import RETRIES, STAGE_SECONDS, UPSERT_BATCH_POINTS, UPSERTS_IN_FLIGHT
+from sync_state import load_sync_state, save_sync_state
+from tracing import in_current_context, span
+from qdrant_store import (
+    DEDUP_LOOKUP, DEDUP_NONE, DEDUP_SCAN, DELETE_BATCH_SIZE, FILE_DELETED, FILE_UNCHANGED, FINGERPRINT_FIELDS,
+    LOOKUP_BATCH_SIZE, SCROLL_PAGE_SIZE, UPSERT_BATCH_SIZE, UPSERT_RETRIES, UPSERT_RETRY_BACKOFF, UPSERT_WORKERS,
+    FileIndex, RewriteIndex, StaleChunks, check_vector_size, drive_point_id, file_fingerprint,
+    file_index_from_columns, index_columns, lookup_status, stale_chunks_filter
+)
+
+
+async def iter_batches(items, batch_size):
+    """Group an async iterable into lists of at most batch_size items"""
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def iterate_in_executor(iterable, executor, batch_size=LOOKUP_BATCH_SIZE):
+    """Drive a blocking iterator on an executor, batch_size items per hop, yielding items"""
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+
+    def next_items():
+        items = []
+        for item in iterator:
+            items.append(item)
+            if len(items) >= batch_size:
+                break
+        return items
+
+    next_items = in_current_context(next_items)
+    while True:
+        items = await loop.run_in_executor(executor, next_items)
+        if not items:
+            return
+        for item in items:
+            yield item
+
+
+async def ensure_file_id_index(qdrant, collection_name):
+    """Create the keyword payload index used to select a file's points"""
+    await qdrant.create_payload_index(
+        collection_name=collection_name,
+        field_name="file_id",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+
+
+async def run_in_executor(executor, func, *args):
+    """Run a CPU-bound call on executor, or the loop's default one, in the current span"""
+    return await asyncio.get_running_loop().run_in_executor(executor, in_current_context(func), *args)
+
+
+async def build_file_index(qdrant, collection_name, page_size=SCROLL_PAGE_SIZE, executor=None):
+    """Scan the whole collection into a FileIndex.
+
+    Hashing and sorting a page of up to page_size points takes a while, so
+    it runs on executor while the next page is scrolled, and the event
+    loop stays free for other requests.
+    """
+    columns = []
+    offset = None
+    while True:
+        with span("qdrant.scroll", page=len(columns)) as page_span:
+            points, offset = await qdrant.scroll(
+                collection_name=collection_name,
+                limit=page_size,
+                offset=offset,
+                with_payload=FINGERPRINT_FIELDS + ["chunk_index"],
+                with_vectors=False
+            )
+            page_span.set_attribute("points", len(points))
+        columns.append(asyncio.ensure_future(run_in_executor(executor, index_columns, points)))
+        if offset is None:
+            break
+    return await run_in_executor(executor, file_index_from_columns, await asyncio.gather(*columns))
+
+
+async def prepare_collection(qdrant, collection_name, vector_size, dedup_mode=DEDUP_SCAN, sync_state_file=None,
+                             executor=None):
+    """Async version of qdrant_store.prepare_collection; returns (page_token, existing_files).
+
+    A scanned index is built on executor, or the loop's default one, and the
+    scan is observed as the fetch_existing stage.
+    """
+    collections = (await qdrant.get_collections()).collections
+    if not any(c.name == collection_name for c in collections):
+        await qdrant.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
+        )
+        await ensure_file_id_index(qdrant, collection_name)
+        return None, FileIndex()
+
+    collection = await qdrant.get_collection(collection_name)
+    check_vector_size(collection_name, collection.config.params.vectors, vector_size)
+    # Collections from before the index existed get it too; creating it again is a no-op
+    await ensure_file_id_index(qdrant, collection_name)
+    # A token saved for a collection that no longer exists is ignored
+    page_token = load_sync_state(sync_state_file).get(collection_name) if sync_state_file else None
+    if page_token or dedup_mode == DEDUP_LOOKUP:
+        return page_token, None
+    if dedup_mode == DEDUP_NONE:
+        # Upserts are idempotent, so every file is simply written again
+        return None, RewriteIndex()
+    started = time.perf_counter()
+    try:
+        return None, await build_file_index(qdrant, collection_name, executor=executor)
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="fetch_existing")
+
+
+async def fetch_fingerprints(qdrant, collection_name, point_ids):
+    """Map each stored point in point_ids to its fingerprint"""
+    with span("qdrant.lookup", points=len(point_ids)):
+        records = await qdrant.retrieve(
+            collection_name=collection_name,
+            ids=point_ids,
+            with_payload=FINGERPRINT_FIELDS,
+            with_vectors=False
+        )
+    return {str(record.id): file_fingerprint(record.payload or {}) for record in records}
+
+
+async def select_changed_files(qdrant, collection_name, files, index, counts, batch_size=LOOKUP_BATCH_SIZE,
+                               settings=None):
+    """Async version of qdrant_store.select_changed_files over an async iterable of files"""
+    if index is not None:
+        async for file in files:
+            status = index.classify(file, settings)
+            counts[status] += 1
+            if status != FILE_UNCHANGED:
+                yield dict(file, sync_status=status)
+        counts[FILE_DELETED] += index.deleted_count()
+        return
+
+    async for batch in iter_batches(files, batch_size):
+        point_ids = [drive_point_id(file['id']) for file in batch]
+        stored = await fetch_fingerprints(qdrant, collection_name, point_ids)
+        for file, point_id in zip(batch, point_ids):
+            status = lookup_status(file, stored.get(point_id), settings)
+            counts[status] += 1
+            if status != FILE_UNCHANGED:
+                yield dict(file, sync_status=status)
+
+
+async def build_point_batches(files, embed_files, stale_chunks, batch_size=UPSERT_BATCH_SIZE):
+    """Yield Batch objects for an async iterable of files, batch_size files at a time.
+
+    embed_files(files, stale_chunks) is an async iterator over the Batch
+    objects of a batch of files, built while earlier batches upload. It
+    tracks the chunk count of every file that already had points in
+    stale_chunks.
+    """
+    async for file_batch in iter_batches(files, batch_size):
+        async for batch in embed_files(file_batch, stale_chunks):
+            yield batch
+
+
+async def sync_drive_files(qdrant, collection_name, files, existing_files, counts, embed_files,
+                           batch_size=UPSERT_BATCH_SIZE, workers=UPSERT_WORKERS, on_stored=None, settings=None):
+    """Async version of qdrant_store.sync_drive_files over an async iterable of files.
+
+    embed_files(files, stale_chunks) extracts, chunks and embeds a batch of
+    files into an async iterator of Batch objects, typically on an executor.
+    settings are the index settings embed_files builds its points with.
+    Returns the number of points written.
+    """
+    changed_files = select_changed_files(qdrant, collection_name, files, existing_files, counts, settings=settings)
+    stale_chunks = StaleChunks()
+
+    async def stored(batch):
+        await delete_stale_chunks(qdrant, collection_name, stale_chunks.finished(batch))
+        if on_stored is not None:
+            on_stored(batch)
+
+    return await upsert_batches(
+        qdrant, collection_name, build_point_batches(changed_files, embed_files, stale_chunks, batch_size),
+        workers, stored
+    )
+
+
+async def upsert_with_retry(qdrant, collection_name, points, retries=UPSERT_RETRIES, backoff=UPSERT_RETRY_BACKOFF):
+    """Upsert points, retrying with exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return await qdrant.upsert(collection_name=collection_name, points=points)
+        except Exception:
+            if attempt == retries:
+                raise
+            RETRIES.inc(operation="qdrant_upsert")
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def upsert_batches(qdrant, collection_name, batches, workers=UPSERT_WORKERS, on_stored=None):
+    """Upsert Batch objects from an async iterable with at most `workers` requests in flight.
+
+    Batches are collected oldest first, like qdrant_store.upsert_batches.
+    on_stored may be a coroutine function; it is awaited before the next
+    batch is collected. Returns the number of points written.
+    """
+    upserted = 0
+    in_flight = deque()
+
+    async def collect_oldest():
+        batch, task = in_flight.popleft()
+        count = await task
+        if on_stored is not None:
+            result = on_stored(batch)
+            if inspect.isawaitable(result):
+                await result
+        return count
+
+    try:
+        async for batch in batches:
+            if len(in_flight) >= workers:
+                upserted += await collect_oldest()
+            in_flight.append((batch, asyncio.ensure_future(_upsert_batch(qdrant, collection_name, batch))))
+        while in_flight:
+            upserted += await collect_oldest()
+    finally:
+        for _, task in in_flight:
+            task.cancel()
+    return upserted
+
+
+async def _upsert_batch(qdrant, collection_name, batch):
+    UPSERT_BATCH_POINTS.observe(len(batch.ids))
+    UPSERTS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        with span("qdrant.upsert", points=len(batch.ids)):
+            await upsert_with_retry(qdrant, collection_name, batch)
+    finally:
+        UPSERTS_IN_FLIGHT.dec()
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="qdrant_upsert")
+    return len(batch.ids)
+
+
+async def delete_points(qdrant, collection_name, point_ids, batch_size=DELETE_BATCH_SIZE):
+    """Delete points by ID, at most batch_size IDs per request. Returns the number of IDs sent"""
+    deleted = 0
+    for i in range(0, len(point_ids), batch_size):
+        batch = point_ids[i:i + batch_size]
+        await qdrant.delete(collection_name=collection_name, points_selector=PointIdsList(points=batch))
+        deleted += len(batch)
+    return deleted
+
+
+async def delete_file_points(qdrant, collection_name, file_ids, batch_size=DELETE_BATCH_SIZE):
+    """Delete every point whose file_id is in file_ids. Returns the number of file IDs sent"""
+    deleted = 0
+    for i in range(0, len(file_ids), batch_size):
+        batch = file_ids[i:i + batch_size]
+        with span("qdrant.delete", files=len(batch)):
+            await qdrant.delete(
+                collection_name=collection_name,
+                points_selector=FilterSelector(
+                    filter=Filter(must=[FieldCondition(key="file_id", match=MatchAny(any=batch))])
+                )
+            )
+        deleted += len(batch)
+    return deleted
+
+
+async def delete_indexed_files(qdrant, collection_name, point_ids, batch_size=DELETE_BATCH_SIZE):
+    """Delete every chunk of the files whose first-chunk point IDs are given. Returns the number of files"""
+    for i in range(0, len(point_ids), batch_size):
+        batch = point_ids[i:i + batch_size]
+        records = await qdrant.retrieve(
+            collection_name=collection_name, ids=batch, with_payload=["file_id"], with_vectors=False
+        )
+        file_ids = [record.payload["file_id"] for record in records if (record.payload or {}).get("file_id")]
+        await delete_file_points(qdrant, collection_name, file_ids, batch_size)
+        unkeyed = [record.id for record in records if not (record.payload or {}).get("file_id")]
+        await delete_points(qdrant, collection_name, unkeyed, batch_size)
+    return len(point_ids)
+
+
+async def delete_stale_chunks(qdrant, collection_name, chunk_counts):
+    """Delete the chunks past each file's new chunk count, in one request"""
+    if not chunk_counts:
+        return
+    with span("qdrant.delete_stale", files=len(chunk_counts)):
+        await qdrant.delete(
+            collection_name=collection_name,
+            points_selector=FilterSelector(filter=stale_chunks_filter(chunk_counts))
+        )
+
+
+async def finish_sync(qdrant, collection_name, existing_files, drive_changes, counts, next_page_token=None,
+                      sync_state_file=None, executor=None):
+    """Async version of qdrant_store.finish_sync; returns the page token that was saved, if any.
+
+    The unmatched point IDs are collected from the index on executor, or the loop's default one.
+    """
+    if drive_changes is not None:
+        counts[FILE_DELETED] += await delete_file_points(qdrant, collection_name, drive_changes.removed_file_ids)
+        next_page_token = drive_changes.new_start_page_token
+    elif existing_files is not None:
+        # The full listing has been consumed, so every point it did not match is stale
+        deleted_point_ids = await run_in_executor(executor, existing_files.deleted_point_ids)
+        await delete_indexed_files(qdrant, collection_name, deleted_point_ids)
+    if next_page_token and sync_state_file:
+        sync_state = load_sync_state(sync_state_file)
+        sync_state[collection_name] = next_page_token
+        save_sync_state(sync_state, sync_state_file)
+    return next_page_token
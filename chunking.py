@@ -0,0 +1,50 @@
+import os
+
+# Characters per chunk and characters repeated at the start of the next chunk
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 1000))
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 150))
+# Preferred break points, coarsest first
+CHUNK_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP, separators=CHUNK_SEPARATORS):
+    """Lazily split text into chunks of at most chunk_size characters.
+
+    A chunk ends after the coarsest separator found in its second half,
+    so paragraphs, then lines, sentences and words are kept together where
+    possible, with a hard cut as the last resort. The next chunk starts up
+    to `overlap` characters earlier, on a word boundary, so context carries
+    across the cut. Short text comes back as a single chunk.
+    """
+    if overlap >= chunk_size:
+        raise ValueError(f"Chunk overlap {overlap} must be smaller than the chunk size {chunk_size}")
+    length = len(text)
+    start = 0
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            end = _break_point(text, start, end, separators)
+        chunk = text[start:end].strip()
+        if chunk:
+            yield chunk
+        if end >= length:
+            break
+        start = _overlap_start(text, start, end, overlap)
+
+
+def _break_point(text, start, end, separators):
+    floor = start + (end - start) // 2
+    for separator in separators:
+        i = text.rfind(separator, floor, end)
+        if i >= 0:
+            return i + len(separator)
+    return end
+
+
+def _overlap_start(text, start, end, overlap):
+    if not overlap:
+        return end
+    candidate = max(end - overlap, start + 1)
+    space = text.find(" ", candidate, end)
+    # Begin at the next word; without a space in the overlap, skip it rather than cut a word
+    return space + 1 if space >= 0 else end
@@ -0,0 +1,184 @@
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import iterparse
+from tracing import in_current_context, span
+
+# Content extraction is opt-in, since it needs the wider drive.readonly scope
+EXTRACT_CONTENT = os.getenv('EXTRACT_CONTENT', '').lower() in ('1', 'true', 'yes')
+DRIVE_METADATA_SCOPE = 'https://www.googleapis.com/auth/drive.metadata.readonly'
+DRIVE_CONTENT_SCOPE = 'https://www.googleapis.com/auth/drive.readonly'
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 4))
+# Per-file limits: bytes downloaded, seconds spent and characters kept
+EXTRACT_MAX_BYTES = int(os.getenv('EXTRACT_MAX_BYTES', 50 * 1024 * 1024))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', 60))
+EXTRACT_MAX_CHARS = int(os.getenv('EXTRACT_MAX_CHARS', 200000))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Downloads up to this size stay in memory, larger ones spill to a temp file
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+# Google Workspace files have no bytes of their own and are exported instead
+GOOGLE_EXPORT_TYPES = {
+    'application/vnd.google-apps.document': 'text/plain',
+    'application/vnd.google-apps.presentation': 'text/plain',
+    'application/vnd.google-apps.spreadsheet': 'text/csv',
+}
+PDF_TYPE = 'application/pdf'
+DOCX_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+TEXT_TYPES = {'text/plain', 'text/markdown', 'text/x-markdown', 'text/csv'}
+TEXT_EXTENSIONS = ('.txt', '.md', '.markdown', '.csv')
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+class ExtractionLimitError(Exception):
+    """A file went over its size or time budget"""
+
+
+def content_scopes(extract_content=EXTRACT_CONTENT):
+    """OAuth scopes the Drive client needs"""
+    return [DRIVE_CONTENT_SCOPE if extract_content else DRIVE_METADATA_SCOPE]
+
+
+def content_kind(file):
+    """How a file's text is read: "text", "pdf" or "docx", or None if it is not supported"""
+    mime_type = file.get('mimeType', '')
+    if mime_type in GOOGLE_EXPORT_TYPES or mime_type in TEXT_TYPES:
+        return "text"
+    if mime_type == PDF_TYPE:
+        return "pdf"
+    if mime_type == DOCX_TYPE:
+        return "docx"
+    if file.get('name', '').lower().endswith(TEXT_EXTENSIONS):
+        return "text"
+    return None
+
+
+def download_file(service, file, out, max_bytes=EXTRACT_MAX_BYTES, deadline=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Stream a file's bytes, or its export for Google Docs, into out chunk by chunk"""
+    from googleapiclient.http import MediaIoBaseDownload
+
+    export_type = GOOGLE_EXPORT_TYPES.get(file.get('mimeType'))
+    if export_type:
+        request = service.files().export_media(fileId=file['id'], mimeType=export_type)
+    else:
+        request = service.files().get_media(fileId=file['id'])
+    downloader = MediaIoBaseDownload(out, request, chunksize=chunk_size)
+    done = False
+    while not done:
+        _, done = downloader.next_chunk()
+        if out.tell() > max_bytes:
+            raise ExtractionLimitError(f"{file['name']} is larger than {max_bytes} bytes")
+        _check_deadline(file, deadline)
+    out.seek(0)
+
+
+def extract_text(fh, kind, max_chars=EXTRACT_MAX_CHARS, file=None, deadline=None):
+    """Read at most max_chars characters of text from a downloaded file object"""
+    if kind == "text":
+        # Four bytes per character covers any UTF-8 text
+        return fh.read(max_chars * 4).decode('utf-8', errors='replace')[:max_chars]
+    if kind == "docx":
+        return _docx_text(fh, max_chars)
+    if kind == "pdf":
+        return _pdf_text(fh, max_chars, file, deadline)
+    raise ValueError(f"Unsupported content kind {kind!r}")
+
+
+def extract_file_content(service, file, max_bytes=EXTRACT_MAX_BYTES, timeout=EXTRACT_TIMEOUT,
+                         max_chars=EXTRACT_MAX_CHARS):
+    """Download a file and return its text, or None if it is unsupported or too large.
+
+    Raises if the download or extraction fails or runs over a limit.
+    """
+    kind = content_kind(file)
+    if kind is None:
+        return None
+    if int(file.get('size') or 0) > max_bytes:
+        print(f"Skipping content of {file['name']}: larger than {max_bytes} bytes")
+        return None
+    deadline = time.monotonic() + timeout
+    with span("extract", kind=kind, mime_type=file.get('mimeType')) as extract_span, \
+            tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as fh:
+        download_file(service, file, fh, max_bytes, deadline)
+        extract_span.set_attribute("bytes", fh.seek(0, os.SEEK_END))
+        fh.seek(0)
+        text = extract_text(fh, kind, max_chars, file, deadline)
+        extract_span.set_attribute("chars", len(text))
+        return text
+
+
+def extract_contents(files, service_factory, workers=EXTRACT_WORKERS, max_bytes=EXTRACT_MAX_BYTES,
+                     timeout=EXTRACT_TIMEOUT, max_chars=EXTRACT_MAX_CHARS):
+    """Add a 'content' field to each file on a worker pool, yielding the files in order.
+
+    service_factory builds a Drive service. It is called once per worker
+    thread, because the underlying http object is not thread-safe. At most
+    2 * workers files are downloaded ahead of the consumer, and each one is
+    spooled to disk once it outgrows SPOOL_MAX_SIZE. A file whose extraction
+    failed keeps only its name and gets the error in 'content_error'.
+    """
+    local = threading.local()
+
+    def extract(file):
+        if not hasattr(local, 'service'):
+            local.service = service_factory()
+        try:
+            content = extract_file_content(local.service, file, max_bytes, timeout, max_chars)
+        except Exception as e:
+            print(f"Skipping content of {file['name']}: {e}")
+            return dict(file, content_error=str(e))
+        return dict(file, content=content) if content else file
+
+    extract = in_current_context(extract)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file in files:
+            pending.append(executor.submit(extract, file))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _check_deadline(file, deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise ExtractionLimitError(f"{file['name'] if file else 'file'} took too long to extract")
+
+
+def _docx_text(fh, max_chars):
+    """Paragraph text of a .docx, parsed incrementally from word/document.xml"""
+    parts, length = [], 0
+    with zipfile.ZipFile(fh) as archive, archive.open('word/document.xml') as document:
+        for _, element in iterparse(document):
+            if element.tag == _WORD_NS + 't' and element.text:
+                parts.append(element.text)
+                length += len(element.text)
+            elif element.tag == _WORD_NS + 'p':
+                parts.append("\n")
+                # Finished paragraphs are dropped so the tree does not grow
+                element.clear()
+            if length >= max_chars:
+                break
+    return "".join(parts).strip()[:max_chars]
+
+
+def _pdf_text(fh, max_chars, file=None, deadline=None):
+    """Page text of a PDF; needs the optional pypdf package"""
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise ImportError("Extracting PDF text needs `pip install pypdf`") from e
+    parts, length = [], 0
+    for page in PdfReader(fh).pages:
+        _check_deadline(file, deadline)
+        text = page.extract_text() or ""
+        parts.append(text)
+        length += len(text)
+        if length >= max_chars:
+            break
+    return "\n".join(parts).strip()[:max_chars]
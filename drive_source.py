@@ -0,0 +1,157 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from chunking import CHUNK_OVERLAP, CHUNK_SIZE
+from metrics import STAGE_SECONDS
+from tracing import in_current_context, span
+
+# Largest page size accepted by files().list
+DRIVE_MAX_PAGE_SIZE = 1000
+DRIVE_FILE_FIELDS = "id, name, mimeType, size, md5Checksum, modifiedTime, version"
+# Payload fields that together identify one revision of a file and how it was indexed
+FINGERPRINT_FIELDS = ["file_name", "md5_checksum", "modified_time", "version", "index_settings"]
+
+# Sync modes: "full" lists the whole Drive on every run, "delta" applies
+# only changes.list results since the page token saved by the last run.
+SYNC_FULL = "full"
+SYNC_DELTA = "delta"
+# Saved page token per collection for delta syncs
+DRIVE_SYNC_STATE_FILE = "drive_sync_state.json"
+
+
+def iter_drive_files(service, page_size=DRIVE_MAX_PAGE_SIZE, fields=DRIVE_FILE_FIELDS):
+    """Yield every Drive file not in the trash, following nextPageToken.
+
+    The next page is requested in the background while the caller works on
+    the current one, so at most two pages are held in memory at a time.
+    """
+    def fetch_page(page_token, page):
+        with span("drive.list_page", page=page) as page_span:
+            started = time.perf_counter()
+            results = service.files().list(
+                pageSize=page_size,
+                pageToken=page_token,
+                q="trashed = false",
+                fields=f"nextPageToken, files({fields})"
+            ).execute()
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="drive_list_page")
+            page_span.set_attribute("files", len(results.get('files', [])))
+            return results
+
+    fetch_page = in_current_context(fetch_page)
+
+    # A single worker keeps all requests on one thread, since the
+    # underlying http object is not thread-safe.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 0
+        future = executor.submit(fetch_page, None, page)
+        while future is not None:
+            results = future.result()
+            next_page_token = results.get('nextPageToken')
+            page += 1
+            future = executor.submit(fetch_page, next_page_token, page) if next_page_token else None
+            yield from results.get('files', [])
+
+
+def get_start_page_token(service):
+    """Cursor for changes.list that starts from the current state of the Drive"""
+    return service.changes().getStartPageToken().execute()['startPageToken']
+
+
+class DriveChanges:
+    """Changed files since a changes.list page token.
+
+    Iterating yields added or modified files. Files that were removed or
+    trashed are collected in removed_file_ids instead. Once iteration is
+    complete, new_start_page_token holds the cursor for the next run.
+    """
+
+    def __init__(self, service, page_token, page_size=DRIVE_MAX_PAGE_SIZE, fields=DRIVE_FILE_FIELDS):
+        self.service = service
+        self.page_token = page_token
+        self.page_size = page_size
+        self.fields = fields
+        self.removed_file_ids = []
+        self.new_start_page_token = None
+
+    def __iter__(self):
+        page_token = self.page_token
+        page = 0
+        while page_token:
+            with span("drive.changes_page", page=page) as page_span:
+                started = time.perf_counter()
+                results = self.service.changes().list(
+                    pageToken=page_token,
+                    pageSize=self.page_size,
+                    spaces='drive',
+                    includeRemoved=True,
+                    fields=(
+                        "nextPageToken, newStartPageToken, "
+                        f"changes(changeType, removed, fileId, file({self.fields}, trashed))"
+                    )
+                ).execute()
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage="drive_changes_page")
+                page_span.set_attribute("changes", len(results.get('changes', [])))
+            page += 1
+            for change in results.get('changes', []):
+                if change.get('changeType', 'file') != 'file':
+                    continue
+                file = change.get('file')
+                if change.get('removed') or not file or file.get('trashed'):
+                    self.removed_file_ids.append(change['fileId'])
+                else:
+                    yield file
+            page_token = results.get('nextPageToken')
+            if 'newStartPageToken' in results:
+                self.new_start_page_token = results['newStartPageToken']
+
+
+def drive_file_text(file):
+    """Text that represents a Drive file for embedding: its name, then its content if extracted"""
+    if file.get('content'):
+        return f"{file['name']}\n{file['content']}"
+    return file['name']
+
+
+def index_settings(embedding_key, extract_content=False, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Describe the settings a file's points were built with.
+
+    embedding_key is the embedding backend's cache_key. The string is part
+    of the fingerprint, so changing the embedding model or any of these
+    settings re-embeds every file on the next sync.
+    """
+    content = "content" if extract_content else "name"
+    return f"{embedding_key};{content};chunks={chunk_size}/{chunk_overlap}"
+
+
+def name_only_settings(settings):
+    """The index settings with content extraction turned off"""
+    embedding_key, _, chunks = settings.rsplit(";", 2)
+    return f"{embedding_key};name;{chunks}"
+
+
+def drive_file_payload(file, settings=None):
+    """Qdrant payload for a Drive file, including its change-detection fields"""
+    return {
+        "file_id": file['id'],
+        "file_name": file['name'],
+        # Google Docs have no md5Checksum; version and modifiedTime still change
+        "md5_checksum": file.get('md5Checksum'),
+        "modified_time": file.get('modifiedTime'),
+        "version": file.get('version'),
+        # A file whose content could not be extracted is stored as indexed by
+        # name only, so it counts as changed and is extracted again next sync
+        "index_settings": name_only_settings(settings) if settings and file.get('content_error') else settings,
+    }
+
+
+def drive_chunk_payload(file, chunk_index, text, settings=None):
+    """Qdrant payload for one chunk of a Drive file"""
+    return dict(drive_file_payload(file, settings), chunk_index=chunk_index, text=text)
+
+
+def file_fingerprint(payload):
+    """64-bit fingerprint of a file revision, computed from its payload"""
+    key = "\0".join(str(payload.get(field) or "") for field in FINGERPRINT_FIELDS)
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
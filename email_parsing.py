@@ -0,0 +1,133 @@
+import email
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.header import decode_header, make_header
+from html.parser import HTMLParser
+
+# Email text is cut to this many characters before it is chunked and embedded
+MAX_EMAIL_CHARS = int(os.getenv('EMAIL_MAX_CHARS', 100000))
+PARSE_WORKERS = os.cpu_count() or 1
+# Raw messages handed to a worker process per task
+PARSE_CHUNK_SIZE = 64
+
+_BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "table", "blockquote"}
+_WHITESPACE_RE = re.compile(r"[ \t\r\f\v]+")
+_BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+
+
+class _HTMLTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head"):
+            self.skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head"):
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    """Strip tags, scripts and styles from an HTML body"""
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    text = _WHITESPACE_RE.sub(" ", "".join(extractor.parts))
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def decode_mime_header(value):
+    if value is None:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+
+def decode_part(part, max_chars=MAX_EMAIL_CHARS):
+    """Decode a text part with its declared charset, never raising on bad bytes"""
+    # Four bytes per character covers any UTF-8 text, so nothing useful is lost
+    payload = (part.get_payload(decode=True) or b"")[:max_chars * 4]
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+def get_email_body(msg, max_chars=MAX_EMAIL_CHARS):
+    """Plain-text body of a message, falling back to its HTML part converted to text"""
+    plain = html = None
+    for part in msg.walk():
+        if part.is_multipart() or part.get_content_disposition() == "attachment":
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain" and plain is None:
+            plain = decode_part(part, max_chars)
+        elif content_type == "text/html" and html is None:
+            html = decode_part(part, max_chars)
+    if plain and plain.strip():
+        return plain
+    if html:
+        return html_to_text(html)
+    return ""
+
+
+def parse_email(raw, max_chars=MAX_EMAIL_CHARS):
+    """Parse raw RFC822 bytes into the fields that are embedded and stored"""
+    msg = email.message_from_bytes(raw)
+    subject = decode_mime_header(msg["subject"])
+    body = get_email_body(msg, max_chars)
+    return {
+        "message_id": (msg["Message-ID"] or "").strip(),
+        "subject": subject,
+        "from": decode_mime_header(msg["from"]),
+        "date": msg["date"],
+        "text": f"Subject: {subject}\nBody: {body}"[:max_chars],
+    }
+
+
+def _parse_chunk(items, max_chars):
+    return [(uid, parse_email(raw, max_chars)) for uid, raw in items]
+
+
+def parse_emails(raw_emails, workers=PARSE_WORKERS, max_chars=MAX_EMAIL_CHARS, chunk_size=PARSE_CHUNK_SIZE):
+    """Parse a stream of (uid, raw bytes) on a process pool, yielding (uid, parsed) in order.
+
+    Work is handed out in chunks of chunk_size messages, with at most two
+    chunks per worker outstanding, so a slow consumer bounds memory use.
+    """
+    if workers <= 1:
+        for uid, raw in raw_emails:
+            yield uid, parse_email(raw, max_chars)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunk = []
+        for item in raw_emails:
+            chunk.append(item)
+            if len(chunk) < chunk_size:
+                continue
+            pending.append(executor.submit(_parse_chunk, chunk, max_chars))
+            chunk = []
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        if chunk:
+            pending.append(executor.submit(_parse_chunk, chunk, max_chars))
+        while pending:
+            yield from pending.popleft().result()
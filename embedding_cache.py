@@ -0,0 +1,107 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+EMBEDDING_CACHE_FILE = os.getenv('EMBEDDING_CACHE_FILE', 'embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# Eviction trims the cache to this fraction of its cap, so it does not run on every write
+EVICT_TO_FRACTION = 0.9
+# SQLite limits the number of bound parameters per statement
+SQL_BATCH_SIZE = 500
+# Rough per-row overhead of the key and bookkeeping columns
+ROW_OVERHEAD_BYTES = 64
+
+
+def content_hash(text):
+    """128-bit digest of a text, the cache key next to the model"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """On-disk map of (model, content hash) to a float32 vector, with LRU eviction.
+
+    Vectors are stored as raw float32 BLOBs in SQLite. Each hit refreshes
+    the row's last_used time. Once the stored bytes go over max_bytes, the
+    least recently used rows are deleted. One connection is shared by all
+    threads, with a lock around it.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_FILE, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, content_hash BLOB NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, content_hash)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        rows, vector_bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self.size_bytes = vector_bytes + rows * ROW_OVERHEAD_BYTES
+
+    def get_many(self, model, hashes):
+        """Map each cached hash in hashes to its vector"""
+        found = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(hashes), SQL_BATCH_SIZE):
+                batch = hashes[i:i + SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.db.execute(
+                    f"SELECT content_hash, vector FROM embeddings WHERE model = ? AND content_hash IN ({placeholders})",
+                    (model, *batch)
+                ).fetchall()
+                for key, blob in rows:
+                    found[bytes(key)] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    self.db.execute(
+                        "UPDATE embeddings SET last_used = ? WHERE model = ? AND content_hash IN "
+                        f"({','.join('?' * len(rows))})",
+                        (now, model, *[key for key, _ in rows])
+                    )
+        return found
+
+    def put_many(self, model, hashes, vectors):
+        """Store one vector per hash, then evict if the cache is over its cap"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        now = time.time()
+        rows = [(model, key, vector.tobytes(), now) for key, vector in zip(hashes, vectors)]
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, content_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self.db.execute("COMMIT")
+            # Replaced rows are counted twice until the next eviction recounts
+            self.size_bytes += sum(len(row[2]) + ROW_OVERHEAD_BYTES for row in rows)
+            if self.size_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        rows, vector_bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self.size_bytes = vector_bytes + rows * ROW_OVERHEAD_BYTES
+        if not rows or self.size_bytes <= self.max_bytes:
+            return
+        row_bytes = self.size_bytes / rows
+        excess = self.size_bytes - self.max_bytes * EVICT_TO_FRACTION
+        count = min(rows, int(excess / row_bytes) + 1)
+        self.db.execute(
+            "DELETE FROM embeddings WHERE (model, content_hash) IN "
+            "(SELECT model, content_hash FROM embeddings ORDER BY last_used LIMIT ?)",
+            (count,)
+        )
+        self.size_bytes -= int(count * row_bytes)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
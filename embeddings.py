@@ -0,0 +1,305 @@
+import hashlib
+import os
+import random
+import re
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+from embedding_cache import EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES, EmbeddingCache, content_hash
+from metrics import RETRIES
+from tracing import in_current_context, span
+
+VECTOR_SIZE = 1536
+EMBED_WORKERS = 2
+DEFAULT_SENTENCE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_COHERE_MODEL = "embed-english-v3.0"
+COHERE_RETRIES = 5
+COHERE_RETRY_BACKOFF = 1.0
+# Keep vectors on disk and reuse them for texts that were embedded before
+EMBEDDING_CACHE = os.getenv('EMBEDDING_CACHE', '').lower() in ('1', 'true', 'yes')
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def _splitmix64(x):
+    """Vectorized SplitMix64 finalizer over a uint64 array"""
+    with np.errstate(over='ignore'):
+        z = x + _GOLDEN_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * _MIX_1
+        z = (z ^ (z >> np.uint64(27))) * _MIX_2
+        return z ^ (z >> np.uint64(31))
+
+
+def name_seed(name):
+    """64-bit seed for a name's vector.
+
+    Derived from a blake2b digest rather than hash(), which is salted per
+    process, so a name gets the same vector in every worker and every run.
+    """
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8, person=b'vector').digest()
+    return int.from_bytes(digest, 'little')
+
+
+def generate_vectors(names, size=VECTOR_SIZE):
+    """Generate one pseudo-random vector per name as an (N, size) float32 array.
+
+    Every component is a counter-based hash of (name seed, column), so the
+    whole batch is produced in a few array operations, without touching the
+    global NumPy RNG. Values are uniform in [0, 1).
+    """
+    seeds = np.fromiter((name_seed(n) for n in names), dtype=np.uint64, count=len(names))
+    columns = np.arange(size, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        bits = _splitmix64(_splitmix64(seeds)[:, None] + columns * _GOLDEN_GAMMA)
+    # Top 24 bits fill a float32 mantissa exactly
+    return (bits >> np.uint64(40)).astype(np.float32) * np.float32(2.0 ** -24)
+
+
+class EmbeddingBackend:
+    """Turns a list of texts into an (N, size) float32 array.
+
+    Subclasses implement embed_batch; embed splits the input into chunks of
+    the backend's preferred batch_size.
+    """
+    name = "base"
+    batch_size = 256
+    default_size = VECTOR_SIZE
+
+    def __init__(self, size=None):
+        self.size = size or self.default_size
+
+    def embed(self, texts):
+        if not texts:
+            return np.empty((0, self.size), dtype=np.float32)
+        chunks = [
+            self.embed_batch(texts[i:i + self.batch_size])
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        return chunks[0] if len(chunks) == 1 else np.vstack(chunks)
+
+    def embed_batch(self, texts):
+        raise NotImplementedError
+
+    @property
+    def cache_key(self):
+        """Identifies the vectors this backend produces, for the embedding cache"""
+        return f"{self.name}/{self.size}"
+
+
+class FakeBackend(EmbeddingBackend):
+    """Deterministic pseudo-random vectors, for tests and benchmarks"""
+    name = "fake"
+
+    def embed_batch(self, texts):
+        return generate_vectors(texts, self.size)
+
+
+class HashingBackend(EmbeddingBackend):
+    """Local, network-free embeddings from a signed hashing vectorizer.
+
+    Features are lowercase word tokens plus character trigrams of each
+    token, so "Q3 report.pdf" and "q3_reports.pdf" land close together.
+    Vectors are L2-normalised, which suits the collection's cosine distance.
+    """
+    name = "hashing"
+    batch_size = 1024
+
+    def embed_batch(self, texts):
+        rows, cols, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature in _text_features(text):
+                col, sign = _feature_slot(feature, self.size)
+                rows.append(row)
+                cols.append(col)
+                signs.append(sign)
+        vectors = np.zeros((len(texts), self.size), dtype=np.float32)
+        np.add.at(vectors, (np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)),
+                  np.asarray(signs, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """Local sentence-transformers model; needs the optional sentence-transformers package"""
+    name = "sentence-transformers"
+    batch_size = 64
+
+    def __init__(self, size=None, model_name=None):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "EMBEDDING_BACKEND=sentence-transformers needs `pip install sentence-transformers`"
+            ) from e
+        self.model_name = model_name or os.getenv('EMBEDDING_MODEL', DEFAULT_SENTENCE_MODEL)
+        self.model = SentenceTransformer(self.model_name)
+        model_size = self.model.get_sentence_embedding_dimension()
+        if size is not None and size != model_size:
+            raise ValueError(f"Model produces {model_size}-dim vectors, but VECTOR_SIZE is {size}")
+        super().__init__(model_size)
+
+    def embed_batch(self, texts):
+        vectors = self.model.encode(
+            texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True
+        )
+        return vectors.astype(np.float32, copy=False)
+
+    @property
+    def cache_key(self):
+        return f"{self.name}/{self.model_name}/{self.size}"
+
+
+class CohereBackend(EmbeddingBackend):
+    """Cohere embed API, 96 texts per request (the API maximum).
+
+    Rate-limited requests are retried with exponential backoff and jitter.
+    """
+    name = "cohere"
+    batch_size = 96
+    default_size = 1024
+
+    def __init__(self, size=None, client=None, model=None):
+        if client is None:
+            import cohere
+            client = cohere.Client(os.getenv('COHERE_API_KEY'))
+        self.client = client
+        self.model = model or os.getenv('COHERE_EMBED_MODEL', DEFAULT_COHERE_MODEL)
+        super().__init__(size)
+
+    def embed_batch(self, texts):
+        for attempt in range(COHERE_RETRIES + 1):
+            try:
+                response = self.client.embed(
+                    texts=texts, model=self.model, input_type="search_document"
+                )
+                return np.asarray(response.embeddings, dtype=np.float32)
+            except Exception as e:
+                if attempt == COHERE_RETRIES or not _is_rate_limited(e):
+                    raise
+                RETRIES.inc(operation="embed")
+                time.sleep(COHERE_RETRY_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+    @property
+    def cache_key(self):
+        return f"{self.name}/{self.model}/{self.size}"
+
+
+class CachedBackend(EmbeddingBackend):
+    """Wraps a backend with an EmbeddingCache.
+
+    Every call looks up all of its texts in one bulk query, sends only the
+    misses to the wrapped backend, and stores their vectors. Duplicate texts
+    within a call are embedded once.
+    """
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+        self.name = backend.name
+        self.batch_size = backend.batch_size
+        super().__init__(backend.size)
+
+    @property
+    def cache_key(self):
+        return self.backend.cache_key
+
+    def embed(self, texts):
+        if not texts:
+            return self.backend.embed(texts)
+        hashes = [content_hash(text) for text in texts]
+        found = self.cache.get_many(self.cache_key, list(set(hashes)))
+        missing = {}
+        for text, key in zip(texts, hashes):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            new_vectors = self.backend.embed(list(missing.values()))
+            self.cache.put_many(self.cache_key, list(missing), new_vectors)
+            found.update(zip(missing, new_vectors))
+        return np.vstack([found[key] for key in hashes])
+
+    def embed_batch(self, texts):
+        return self.embed(texts)
+
+
+def _is_rate_limited(error):
+    status = getattr(error, 'status_code', None) or getattr(error, 'http_status', None)
+    return status == 429 or type(error).__name__ == "TooManyRequestsError"
+
+
+EMBEDDING_BACKENDS = {
+    backend.name: backend
+    for backend in (FakeBackend, HashingBackend, SentenceTransformerBackend, CohereBackend)
+}
+
+
+@lru_cache(maxsize=None)
+def get_embedding_backend(name=None, size=None):
+    """Build the backend named by EMBEDDING_BACKEND, sized by VECTOR_SIZE.
+
+    Backends are cached, so a model is only loaded once per process. With
+    EMBEDDING_CACHE set, vectors are also cached on disk across runs.
+    """
+    name = name or os.getenv('EMBEDDING_BACKEND', HashingBackend.name)
+    if size is None and os.getenv('VECTOR_SIZE'):
+        size = int(os.getenv('VECTOR_SIZE'))
+    try:
+        backend_class = EMBEDDING_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown embedding backend {name!r}, expected one of {sorted(EMBEDDING_BACKENDS)}")
+    backend = backend_class(size)
+    if EMBEDDING_CACHE:
+        backend = CachedBackend(backend, _shared_cache())
+    return backend
+
+
+@lru_cache(maxsize=None)
+def _shared_cache():
+    return EmbeddingCache(EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_BYTES)
+
+
+def embed_batches(backend, batches, text_of, workers=EMBED_WORKERS):
+    """Embed batches of items on a worker pool, yielding (batch, vectors) in order.
+
+    At most `workers` batches are embedded ahead of the consumer, so a slow
+    upload stage holds back the embedding stage instead of piling up vectors.
+    """
+    embed = in_current_context(_embed_texts)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            pending.append((batch, executor.submit(embed, backend, [text_of(item) for item in batch])))
+            if len(pending) > workers:
+                done_batch, future = pending.popleft()
+                yield done_batch, future.result()
+        while pending:
+            done_batch, future = pending.popleft()
+            yield done_batch, future.result()
+
+
+def _embed_texts(backend, texts):
+    with span("embed.request", backend=backend.name, texts=len(texts)):
+        return backend.embed(texts)
+
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _text_features(text):
+    for token in _TOKEN_RE.findall(text.lower()):
+        yield token
+        padded = f"<{token}>"
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3]
+
+
+@lru_cache(maxsize=1 << 16)
+def _feature_slot(feature, size):
+    h = zlib.crc32(feature.encode('utf-8'))
+    return h % size, 1.0 if h & 0x80000000 else -1.0
@@ -3,16 +3,31 @@ import os
 import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+from qdrant_client import AsyncQdrantClient
 from google.auth.transport.requests import Request
-import numpy as np
-import uuid
 from dotenv import load_dotenv
-import time
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from fastapi import FastAPI, HTTPException, Path
-from fastapi.responses import JSONResponse
+from drive_source import (
+    DRIVE_SYNC_STATE_FILE, SYNC_DELTA, SYNC_FULL, DriveChanges, get_start_page_token, index_settings,
+    iter_drive_files
+)
+from embeddings import EMBED_WORKERS, get_embedding_backend
+from qdrant_store import (
+    DEDUP_SCAN, FILE_CHANGED, FILE_DELETED, FILE_NEW, FILE_REWRITTEN, FILE_UNCHANGED, UPSERT_BATCH_SIZE,
+    UPSERT_WORKERS, file_point_batches, sync_summary
+)
+from async_qdrant_store import finish_sync, iterate_in_executor, prepare_collection, sync_drive_files
+from metrics import CONTENT_TYPE, HTTP_IN_FLIGHT, render_metrics
+from sync_context import SyncContext
+from tracing import current_span, in_current_context, span, traced
+from sync_jobs import PROGRESS_EMBEDDED, PROGRESS_LISTED, PROGRESS_UPSERTED
+from content_extraction import EXTRACT_CONTENT, EXTRACT_WORKERS, content_scopes
+from fastapi import FastAPI, HTTPException, Path, Request as HTTPRequest
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 from typing import Dict, Any
 import re
@@ -26,7 +41,9 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+SCOPES = content_scopes()
+# Threads for blocking Google and embedding calls, shared by all requests
+BLOCKING_WORKERS = 8
 
 # OAuth configuration
 CLIENT_CONFIG = {
@@ -46,6 +63,10 @@ class SuccessResponse(BaseModel):
     status: str = "success"
     collection_name: str
     new_files_added: int
+    files_updated: int = 0
+    files_unchanged: int = 0
+    files_rewritten: int = 0
+    files_deleted_in_drive: int = 0
     total_time: str
     message: str
 
@@ -61,13 +82,33 @@ app = FastAPI(
     version="1.0.0"
 )
 
+@app.middleware("http")
+async def count_in_flight(request: HTTPRequest, call_next):
+    HTTP_IN_FLIGHT.inc()
+    try:
+        return await call_next(request)
+    finally:
+        HTTP_IN_FLIGHT.dec()
+
 class DriveToQdrantApp:
     def __init__(self):
-        self.qdrant = QdrantClient(
+        self.qdrant = AsyncQdrantClient(
             url=os.getenv('QDRANT_URL'),
             api_key=os.getenv('QDRANT_API_KEY')
         )
-        self.operation_times = {}
+        # Blocking work runs here, so the event loop keeps serving other requests
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('BLOCKING_WORKERS', BLOCKING_WORKERS)))
+        self.dedup_mode = os.getenv('DEDUP_MODE', DEDUP_SCAN)
+        self.upsert_batch_size = int(os.getenv('UPSERT_BATCH_SIZE', UPSERT_BATCH_SIZE))
+        self.upsert_workers = int(os.getenv('UPSERT_WORKERS', UPSERT_WORKERS))
+        self.embedder = get_embedding_backend()
+        self.embed_workers = int(os.getenv('EMBED_WORKERS', EMBED_WORKERS))
+        self.sync_mode = os.getenv('SYNC_MODE', SYNC_FULL)
+        self.sync_state_file = os.getenv('DRIVE_SYNC_STATE_FILE', DRIVE_SYNC_STATE_FILE)
+        self.extract_content = EXTRACT_CONTENT
+        self.extract_workers = EXTRACT_WORKERS
+        # Concurrent syncs share token.pickle, so only one reads or refreshes it at a time
+        self.auth_lock = threading.Lock()
 
     def sanitize_collection_name(self, name: str) -> str:
         """Sanitize the collection name to meet Qdrant requirements"""
@@ -84,51 +125,19 @@ class DriveToQdrantApp:
         else:
             return str(timedelta(seconds=int(seconds)))
 
-    def start_timer(self, operation):
-        self.operation_times[operation] = time.time()
-
-    def end_timer(self, operation):
-        if operation in self.operation_times:
-            duration = time.time() - self.operation_times[operation]
-            del self.operation_times[operation]
-            return duration
-        return 0
-
-    async def get_existing_files(self, collection_name):
-        self.start_timer("fetch_existing")
-        try:
-            points = self.qdrant.scroll(
-                collection_name=collection_name,
-                limit=10000,
-                with_payload=True,
-                with_vectors=False
-            )[0]
-            existing_files = {point.payload["file_name"] for point in points}
-            return existing_files
-        except Exception as e:
-            logger.error(f"Error fetching existing files: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail={"error_code": "FETCH_ERROR", "message": str(e)}
-            )
-        finally:
-            self.end_timer("fetch_existing")
+    async def run_blocking(self, func, *args):
+        """Run a blocking Google, file or embedding call on the bounded executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, in_current_context(func), *args)
 
-    async def handle_collection(self, collection_name):
-        self.start_timer("collection_handle")
+    @traced("sync.handle_collection")
+    async def handle_collection(self, ctx):
+        ctx.start_timer("collection_handle")
         try:
-            collections = self.qdrant.get_collections().collections
-            exists = any(c.name == collection_name for c in collections)
-
-            if exists:
-                existing_files = await self.get_existing_files(collection_name)
-                return True, existing_files
-
-            self.qdrant.create_collection(
-                collection_name=collection_name,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
+            ctx.page_token, existing_files = await prepare_collection(
+                self.qdrant, ctx.collection_name, self.embedder.size, self.dedup_mode,
+                self.sync_state_file if self.sync_mode == SYNC_DELTA else None, self.executor
             )
-            return True, set()
+            return True, existing_files
 
         except Exception as e:
             logger.error(f"Collection handling error: {e}")
@@ -137,29 +146,34 @@ class DriveToQdrantApp:
                 detail={"error_code": "COLLECTION_ERROR", "message": str(e)}
             )
         finally:
-            self.end_timer("collection_handle")
+            ctx.end_timer("collection_handle")
 
-    def google_auth(self):
-        self.start_timer("auth")
+    @traced("sync.auth")
+    def google_auth(self, ctx):
+        ctx.start_timer("auth")
         try:
-            creds = None
-            token_file = '/tmp/token.pickle' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'token.pickle'
-
-            if os.path.exists(token_file):
-                with open(token_file, 'rb') as token:
-                    creds = pickle.load(token)
-
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_config(CLIENT_CONFIG, SCOPES)
-                    creds = flow.run_local_server(port=8080)
-
-                with open(token_file, 'wb') as token:
-                    pickle.dump(creds, token)
-
-            return creds
+            with self.auth_lock:
+                creds = None
+                token_file = '/tmp/token.pickle' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'token.pickle'
+
+                if os.path.exists(token_file):
+                    with open(token_file, 'rb') as token:
+                        creds = pickle.load(token)
+                    # A token granted for other scopes, e.g. before content extraction was enabled, is dropped
+                    if creds and not creds.has_scopes(SCOPES):
+                        creds = None
+
+                if not creds or not creds.valid:
+                    if creds and creds.expired and creds.refresh_token:
+                        creds.refresh(Request())
+                    else:
+                        flow = InstalledAppFlow.from_client_config(CLIENT_CONFIG, SCOPES)
+                        creds = flow.run_local_server(port=8080)
+
+                    with open(token_file, 'wb') as token:
+                        pickle.dump(creds, token)
+
+                return creds
         except Exception as e:
             logger.error(f"Authentication error: {e}")
             raise HTTPException(
@@ -167,94 +181,140 @@ class DriveToQdrantApp:
                 detail={"error_code": "AUTH_ERROR", "message": str(e)}
             )
         finally:
-            self.end_timer("auth")
+            ctx.end_timer("auth")
+
+    def build_drive_service(self, credentials):
+        """Drive client for the signed-in user; each thread needs its own"""
+        return build('drive', 'v3', credentials=credentials)
 
-    async def fetch_drive_files(self):
-        self.start_timer("drive_fetch")
+    async def fetch_drive_files(self, ctx):
+        """Yield Drive files page by page so inserting can start on the first page.
+
+        In delta mode with a saved page token only files changed since the last
+        sync are yielded. Every Google call runs on the executor.
+        """
+        ctx.drive_files_count = 0
         try:
-            creds = self.google_auth()
-            service = build('drive', 'v3', credentials=creds)
-            results = service.files().list(
-                pageSize=10, fields="files(id, name)").execute()
-            items = results.get('files', [])
-
-            if not items:
-                return []
-            return items
+            ctx.drive_credentials = await self.run_blocking(self.google_auth, ctx)
+            service = await self.run_blocking(self.build_drive_service, ctx.drive_credentials)
+            if ctx.page_token:
+                ctx.drive_changes = DriveChanges(service, ctx.page_token)
+                items = ctx.drive_changes
+            else:
+                ctx.drive_changes = None
+                # Taken before listing, so changes made during the listing are applied next time
+                if self.sync_mode == SYNC_DELTA:
+                    ctx.next_page_token = await self.run_blocking(get_start_page_token, service)
+                else:
+                    ctx.next_page_token = None
+                items = iter_drive_files(service)
+            async for item in iterate_in_executor(items, self.executor):
+                ctx.drive_files_count += 1
+                ctx.add_progress(PROGRESS_LISTED)
+                yield item
         except Exception as e:
             logger.error(f"Error fetching drive files: {e}")
             raise HTTPException(
                 status_code=500,
                 detail={"error_code": "DRIVE_ERROR", "message": str(e)}
             )
-        finally:
-            self.end_timer("drive_fetch")
 
-    def generate_vector(self, file_name):
-        np.random.seed(hash(file_name) % (2**32))
-        return np.random.random(1536).tolist()
+    async def embed_files(self, ctx, files, stale_chunks=None):
+        """Extract, chunk and embed a batch of files on the executor, yielding Batch objects as they are built.
+
+        Each Batch is built by its own executor call, so only the batches the
+        embedding workers are ahead on and those being uploaded are in memory.
+        """
+        service_factory = None
+        if self.extract_content:
+            service_factory = lambda: self.build_drive_service(ctx.drive_credentials)
+        batches = file_point_batches(
+            files, self.embedder, self.upsert_batch_size, self.embed_workers, service_factory, self.extract_workers,
+            stale_chunks
+        )
 
-    async def insert_into_qdrant(self, files, collection_name, existing_files):
-        self.start_timer("qdrant_insert")
+        def next_batch():
+            ctx.start_timer("embed")
+            try:
+                with span("embed", files=len(files)) as embed_span:
+                    batch = next(batches, None)
+                    embed_span.set_attribute("points", len(batch.ids) if batch else 0)
+                    return batch
+            finally:
+                ctx.end_timer("embed")
+
+        while True:
+            batch = await self.run_blocking(next_batch)
+            if batch is None:
+                return
+            ctx.add_progress(PROGRESS_EMBEDDED, len(batch.ids))
+            yield batch
+
+    async def insert_into_qdrant(self, ctx, files):
         try:
-            points = []
-            new_files_count = 0
-
-            for file in files:
-                if file['name'] not in existing_files:
-                    vector = self.generate_vector(file['name'])
-                    point = PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector=vector,
-                        payload={"file_name": file['name']}
-                    )
-                    points.append(point)
-                    new_files_count += 1
-
-            if points:
-                self.qdrant.upsert(
-                    collection_name=collection_name,
-                    points=points
+            upserted_count = await sync_drive_files(
+                self.qdrant, ctx.collection_name, files, ctx.existing_files, ctx.sync_counts,
+                lambda file_batch, stale_chunks: self.embed_files(ctx, file_batch, stale_chunks),
+                self.upsert_batch_size, self.upsert_workers,
+                on_stored=lambda batch: ctx.add_progress(PROGRESS_UPSERTED, len(batch.ids)),
+                settings=index_settings(self.embedder.cache_key, self.extract_content)
+            )
+            with span("sync.finish"):
+                await finish_sync(
+                    self.qdrant, ctx.collection_name, ctx.existing_files, ctx.drive_changes, ctx.sync_counts,
+                    ctx.next_page_token, self.sync_state_file, self.executor
                 )
-                return True, new_files_count
-            return True, 0
+            return True, upserted_count
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Failed to sync to Qdrant: {e}")
             raise HTTPException(
                 status_code=500,
                 detail={"error_code": "SYNC_ERROR", "message": str(e)}
             )
-        finally:
-            self.end_timer("qdrant_insert")
 
-    async def run_sync(self, user_name: str) -> Dict[str, Any]:
-        self.start_timer("total")
+    @traced("sync")
+    async def run_sync(self, user_name: str, progress: Counter = None) -> Dict[str, Any]:
+        """Sync Drive into a collection, adding listed, embedded and upserted counts to progress"""
+        ctx = SyncContext(self.sanitize_collection_name(user_name), progress)
+        current_span().set_attribute("collection", ctx.collection_name)
+        ctx.start_timer("total")
         try:
-            collection_name = self.sanitize_collection_name(user_name)
-            
-            success, existing_files = await self.handle_collection(collection_name)
-            files = await self.fetch_drive_files()
+            collection_name = ctx.collection_name
             
-            if files:
-                success, new_files_count = await self.insert_into_qdrant(files, collection_name, existing_files)
-                total_time = self.format_time_delta(self.end_timer('total'))
+            success, ctx.existing_files = await self.handle_collection(ctx)
+            files = self.fetch_drive_files(ctx)
+            success, upserted_count = await self.insert_into_qdrant(ctx, files)
+            ctx.record_result(True)
+            current_span().set_attributes(upserted=upserted_count, **ctx.sync_counts)
+
+            if ctx.drive_files_count or ctx.sync_counts[FILE_DELETED]:
+                total_time = self.format_time_delta(ctx.end_timer('total'))
+                new_files_count = ctx.sync_counts[FILE_NEW]
+                changed_files_count = ctx.sync_counts[FILE_CHANGED]
                 
                 return SuccessResponse(
                     collection_name=collection_name,
                     new_files_added=new_files_count,
+                    files_updated=changed_files_count,
+                    files_unchanged=ctx.sync_counts[FILE_UNCHANGED],
+                    files_rewritten=ctx.sync_counts[FILE_REWRITTEN],
+                    files_deleted_in_drive=ctx.sync_counts[FILE_DELETED],
                     total_time=total_time,
-                    message=f"Sync completed: {new_files_count} new files added"
+                    message=f"Sync completed: {sync_summary(ctx.sync_counts)}"
                 )
             
             return SuccessResponse(
                 collection_name=collection_name,
                 new_files_added=0,
-                total_time=self.format_time_delta(self.end_timer('total')),
-                message="No files found in Drive"
+                total_time=self.format_time_delta(ctx.end_timer('total')),
+                message="No changes in Drive" if ctx.drive_changes is not None else "No files found in Drive"
             )
             
         except Exception as e:
-            self.end_timer('total')
+            ctx.end_timer('total')
+            ctx.record_result(False)
             if isinstance(e, HTTPException):
                 raise e
             raise HTTPException(
@@ -265,18 +325,20 @@ class DriveToQdrantApp:
 # Initialize the DriveToQdrantApp instance
 drive_app = DriveToQdrantApp()
 
+
 @app.get("/sync/{username}")
 async def sync_drive_to_qdrant(
     username: str = Path(..., min_length=1, max_length=64, regex="^[a-zA-Z0-9_-]+$")
 ):
     """
-    Sync Google Drive files to Qdrant collection for a specific user
+    Sync Google Drive files to the Qdrant collection of a specific user
     
     Parameters:
     - username: String to be used as the collection name (from URL path)
     
     Returns:
-    - JSON with sync results including status and statistics
+    - JSON with sync results. The sync runs within the request, since a
+      Lambda invocation is frozen once it has returned its response.
     """
     try:
         result = await drive_app.run_sync(username)
@@ -297,5 +359,10 @@ async def health_check():
     """Health check endpoint for AWS"""
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latency histograms, file and point counters, batch sizes, retries and in-flight requests, for Prometheus"""
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
 # Create handler for AWS Lambda
 handler = Mangum(app)
\ No newline at end of file
@@ -2,20 +2,38 @@ import os
 import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+from qdrant_client import AsyncQdrantClient
 from google.auth.transport.requests import Request
-import numpy as np
-import uuid
 from dotenv import load_dotenv
-import time
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from fastapi import FastAPI, HTTPException
+from drive_source import (
+    DRIVE_SYNC_STATE_FILE, SYNC_DELTA, SYNC_FULL, DriveChanges, get_start_page_token, index_settings,
+    iter_drive_files
+)
+from embeddings import EMBED_WORKERS, get_embedding_backend
+from qdrant_store import (
+    DEDUP_SCAN, FILE_CHANGED, FILE_DELETED, FILE_NEW, FILE_REWRITTEN, FILE_UNCHANGED, UPSERT_BATCH_SIZE,
+    UPSERT_WORKERS, file_point_batches, sync_summary
+)
+from async_qdrant_store import finish_sync, iterate_in_executor, prepare_collection, sync_drive_files
+from metrics import CONTENT_TYPE, HTTP_IN_FLIGHT, render_metrics
+from sync_context import SyncContext
+from tracing import current_span, in_current_context, span, traced
+from sync_jobs import PROGRESS_EMBEDDED, PROGRESS_LISTED, PROGRESS_UPSERTED, SyncJobQueue
+from content_extraction import EXTRACT_CONTENT, EXTRACT_WORKERS, content_scopes
+from fastapi import FastAPI, HTTPException, Request as HTTPRequest
+from fastapi.responses import Response
 from typing import Dict, Any
 import re
 
-SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+SCOPES = content_scopes()
 load_dotenv()
+# Threads for blocking Google and embedding calls, shared by all requests
+BLOCKING_WORKERS = 8
 
 # OAuth configuration
 CLIENT_CONFIG = {
@@ -32,13 +50,33 @@ CLIENT_CONFIG = {
 
 app = FastAPI(title="Drive to Qdrant API")
 
+@app.middleware("http")
+async def count_in_flight(request: HTTPRequest, call_next):
+    HTTP_IN_FLIGHT.inc()
+    try:
+        return await call_next(request)
+    finally:
+        HTTP_IN_FLIGHT.dec()
+
 class DriveToQdrantApp:
     def __init__(self):
-        self.qdrant = QdrantClient(
+        self.qdrant = AsyncQdrantClient(
             url=os.getenv('QDRANT_URL'),
             api_key=os.getenv('QDRANT_API_KEY')
         )
-        self.operation_times = {}
+        # Blocking work runs here, so the event loop keeps serving other requests
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('BLOCKING_WORKERS', BLOCKING_WORKERS)))
+        self.dedup_mode = os.getenv('DEDUP_MODE', DEDUP_SCAN)
+        self.upsert_batch_size = int(os.getenv('UPSERT_BATCH_SIZE', UPSERT_BATCH_SIZE))
+        self.upsert_workers = int(os.getenv('UPSERT_WORKERS', UPSERT_WORKERS))
+        self.embedder = get_embedding_backend()
+        self.embed_workers = int(os.getenv('EMBED_WORKERS', EMBED_WORKERS))
+        self.sync_mode = os.getenv('SYNC_MODE', SYNC_FULL)
+        self.sync_state_file = os.getenv('DRIVE_SYNC_STATE_FILE', DRIVE_SYNC_STATE_FILE)
+        self.extract_content = EXTRACT_CONTENT
+        self.extract_workers = EXTRACT_WORKERS
+        # Concurrent syncs share token.pickle, so only one reads or refreshes it at a time
+        self.auth_lock = threading.Lock()
 
     def sanitize_collection_name(self, name: str) -> str:
         """Sanitize the collection name to meet Qdrant requirements"""
@@ -57,176 +95,231 @@ class DriveToQdrantApp:
         else:
             return str(timedelta(seconds=int(seconds)))
 
-    def start_timer(self, operation):
-        self.operation_times[operation] = time.time()
-
-    def end_timer(self, operation):
-        if operation in self.operation_times:
-            duration = time.time() - self.operation_times[operation]
-            del self.operation_times[operation]
-            return duration
-        return 0
-
-    async def get_existing_files(self, collection_name):
-        self.start_timer("fetch_existing")
-        try:
-            points = self.qdrant.scroll(
-                collection_name=collection_name,
-                limit=10000,
-                with_payload=True,
-                with_vectors=False
-            )[0]
-            existing_files = {point.payload["file_name"] for point in points}
-            return existing_files
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error fetching existing files: {str(e)}")
-        finally:
-            self.end_timer("fetch_existing")
+    async def run_blocking(self, func, *args):
+        """Run a blocking Google, file or embedding call on the bounded executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, in_current_context(func), *args)
 
-    async def handle_collection(self, collection_name):
-        self.start_timer("collection_handle")
+    @traced("sync.handle_collection")
+    async def handle_collection(self, ctx):
+        ctx.start_timer("collection_handle")
         try:
-            collections = self.qdrant.get_collections().collections
-            exists = any(c.name == collection_name for c in collections)
-
-            if exists:
-                existing_files = await self.get_existing_files(collection_name)
-                return True, existing_files
-
-            self.qdrant.create_collection(
-                collection_name=collection_name,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
+            ctx.page_token, existing_files = await prepare_collection(
+                self.qdrant, ctx.collection_name, self.embedder.size, self.dedup_mode,
+                self.sync_state_file if self.sync_mode == SYNC_DELTA else None, self.executor
             )
-            return True, set()
+            return True, existing_files
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Collection handling error: {str(e)}")
         finally:
-            self.end_timer("collection_handle")
+            ctx.end_timer("collection_handle")
 
-    def google_auth(self):
-        self.start_timer("auth")
+    @traced("sync.auth")
+    def google_auth(self, ctx):
+        ctx.start_timer("auth")
         try:
-            creds = None
-            token_file = 'token.pickle'
+            with self.auth_lock:
+                creds = None
+                token_file = 'token.pickle'
 
-            if os.path.exists(token_file):
-                with open(token_file, 'rb') as token:
-                    creds = pickle.load(token)
+                if os.path.exists(token_file):
+                    with open(token_file, 'rb') as token:
+                        creds = pickle.load(token)
+                    # A token granted for other scopes, e.g. before content extraction was enabled, is dropped
+                    if creds and not creds.has_scopes(SCOPES):
+                        creds = None
 
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_config(CLIENT_CONFIG, SCOPES)
-                    creds = flow.run_local_server(port=8080)
+                if not creds or not creds.valid:
+                    if creds and creds.expired and creds.refresh_token:
+                        creds.refresh(Request())
+                    else:
+                        flow = InstalledAppFlow.from_client_config(CLIENT_CONFIG, SCOPES)
+                        creds = flow.run_local_server(port=8080)
 
-                with open(token_file, 'wb') as token:
-                    pickle.dump(creds, token)
+                    with open(token_file, 'wb') as token:
+                        pickle.dump(creds, token)
 
-            return creds
+                return creds
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Authentication error: {str(e)}")
         finally:
-            self.end_timer("auth")
+            ctx.end_timer("auth")
+
+    def build_drive_service(self, credentials):
+        """Drive client for the signed-in user; each thread needs its own"""
+        return build('drive', 'v3', credentials=credentials)
 
-    async def fetch_drive_files(self):
-        self.start_timer("drive_fetch")
+    async def fetch_drive_files(self, ctx):
+        """Yield Drive files page by page so inserting can start on the first page.
+
+        In delta mode with a saved page token only files changed since the last
+        sync are yielded. Every Google call runs on the executor.
+        """
+        ctx.drive_files_count = 0
         try:
-            creds = self.google_auth()
-            service = build('drive', 'v3', credentials=creds)
-            results = service.files().list(
-                pageSize=10, fields="files(id, name)").execute()
-            items = results.get('files', [])
-
-            if not items:
-                return []
-            return items
+            ctx.drive_credentials = await self.run_blocking(self.google_auth, ctx)
+            service = await self.run_blocking(self.build_drive_service, ctx.drive_credentials)
+            if ctx.page_token:
+                ctx.drive_changes = DriveChanges(service, ctx.page_token)
+                items = ctx.drive_changes
+            else:
+                ctx.drive_changes = None
+                # Taken before listing, so changes made during the listing are applied next time
+                if self.sync_mode == SYNC_DELTA:
+                    ctx.next_page_token = await self.run_blocking(get_start_page_token, service)
+                else:
+                    ctx.next_page_token = None
+                items = iter_drive_files(service)
+            async for item in iterate_in_executor(items, self.executor):
+                ctx.drive_files_count += 1
+                ctx.add_progress(PROGRESS_LISTED)
+                yield item
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error fetching drive files: {str(e)}")
-        finally:
-            self.end_timer("drive_fetch")
 
-    def generate_vector(self, file_name):
-        np.random.seed(hash(file_name) % (2**32))
-        return np.random.random(1536).tolist()
+    async def embed_files(self, ctx, files, stale_chunks=None):
+        """Extract, chunk and embed a batch of files on the executor, yielding Batch objects as they are built.
+
+        Each Batch is built by its own executor call, so only the batches the
+        embedding workers are ahead on and those being uploaded are in memory.
+        """
+        service_factory = None
+        if self.extract_content:
+            service_factory = lambda: self.build_drive_service(ctx.drive_credentials)
+        batches = file_point_batches(
+            files, self.embedder, self.upsert_batch_size, self.embed_workers, service_factory, self.extract_workers,
+            stale_chunks
+        )
+
+        def next_batch():
+            ctx.start_timer("embed")
+            try:
+                with span("embed", files=len(files)) as embed_span:
+                    batch = next(batches, None)
+                    embed_span.set_attribute("points", len(batch.ids) if batch else 0)
+                    return batch
+            finally:
+                ctx.end_timer("embed")
 
-    async def insert_into_qdrant(self, files, collection_name, existing_files):
-        self.start_timer("qdrant_insert")
+        while True:
+            batch = await self.run_blocking(next_batch)
+            if batch is None:
+                return
+            ctx.add_progress(PROGRESS_EMBEDDED, len(batch.ids))
+            yield batch
+
+    async def insert_into_qdrant(self, ctx, files):
         try:
-            points = []
-            new_files_count = 0
-
-            for file in files:
-                if file['name'] not in existing_files:
-                    vector = self.generate_vector(file['name'])
-                    point = PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector=vector,
-                        payload={"file_name": file['name']}
-                    )
-                    points.append(point)
-                    new_files_count += 1
-
-            if points:
-                self.qdrant.upsert(
-                    collection_name=collection_name,
-                    points=points
+            upserted_count = await sync_drive_files(
+                self.qdrant, ctx.collection_name, files, ctx.existing_files, ctx.sync_counts,
+                lambda file_batch, stale_chunks: self.embed_files(ctx, file_batch, stale_chunks),
+                self.upsert_batch_size, self.upsert_workers,
+                on_stored=lambda batch: ctx.add_progress(PROGRESS_UPSERTED, len(batch.ids)),
+                settings=index_settings(self.embedder.cache_key, self.extract_content)
+            )
+            with span("sync.finish"):
+                await finish_sync(
+                    self.qdrant, ctx.collection_name, ctx.existing_files, ctx.drive_changes, ctx.sync_counts,
+                    ctx.next_page_token, self.sync_state_file, self.executor
                 )
-                return True, new_files_count
-            return True, 0
+            return True, upserted_count
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to sync to Qdrant: {str(e)}")
-        finally:
-            self.end_timer("qdrant_insert")
 
-    async def run_sync(self, collection_name: str) -> Dict[str, Any]:
-        self.start_timer("total")
+    @traced("sync")
+    async def run_sync(self, collection_name: str, progress: Counter = None) -> Dict[str, Any]:
+        """Sync Drive into a collection, adding listed, embedded and upserted counts to progress"""
+        ctx = SyncContext(self.sanitize_collection_name(collection_name), progress)
+        current_span().set_attribute("collection", ctx.collection_name)
+        ctx.start_timer("total")
         try:
-            sanitized_collection_name = self.sanitize_collection_name(collection_name)
-            
-            success, existing_files = await self.handle_collection(sanitized_collection_name)
-            files = await self.fetch_drive_files()
+            sanitized_collection_name = ctx.collection_name
             
-            if files:
-                success, new_files_count = await self.insert_into_qdrant(files, sanitized_collection_name, existing_files)
-                total_time = self.format_time_delta(self.end_timer('total'))
+            success, ctx.existing_files = await self.handle_collection(ctx)
+            files = self.fetch_drive_files(ctx)
+            success, upserted_count = await self.insert_into_qdrant(ctx, files)
+            ctx.record_result(True)
+            current_span().set_attributes(upserted=upserted_count, **ctx.sync_counts)
+
+            if ctx.drive_files_count or ctx.sync_counts[FILE_DELETED]:
+                total_time = self.format_time_delta(ctx.end_timer('total'))
+                new_files_count = ctx.sync_counts[FILE_NEW]
+                changed_files_count = ctx.sync_counts[FILE_CHANGED]
                 
                 return {
                     "status": "success",
                     "collection_name": sanitized_collection_name,
                     "new_files_added": new_files_count,
+                    "files_updated": changed_files_count,
+                    "files_unchanged": ctx.sync_counts[FILE_UNCHANGED],
+                    "files_rewritten": ctx.sync_counts[FILE_REWRITTEN],
+                    "files_deleted_in_drive": ctx.sync_counts[FILE_DELETED],
                     "total_time": total_time,
-                    "message": f"Sync completed: {new_files_count} new files added"
+                    "message": f"Sync completed: {sync_summary(ctx.sync_counts)}"
                 }
             
             return {
                 "status": "success",
                 "collection_name": sanitized_collection_name,
                 "new_files_added": 0,
-                "total_time": self.format_time_delta(self.end_timer('total')),
-                "message": "No files found in Drive"
+                "total_time": self.format_time_delta(ctx.end_timer('total')),
+                "message": "No changes in Drive" if ctx.drive_changes is not None else "No files found in Drive"
             }
             
         except Exception as e:
-            self.end_timer('total')
+            ctx.end_timer('total')
+            ctx.record_result(False)
             raise HTTPException(status_code=500, detail=str(e))
 
 # Initialize the DriveToQdrantApp instance
 drive_app = DriveToQdrantApp()
 
-@app.post("/sync/{collection_name}")
+
+async def run_sync_job(job):
+    return await drive_app.run_sync(job.collection_name, job.progress)
+
+sync_jobs = SyncJobQueue(run_sync_job)
+
+@app.post("/sync/{collection_name}", status_code=202)
 async def sync_drive_to_qdrant(collection_name: str):
     """
-    Sync Google Drive files to Qdrant collection
+    Queue a sync of Google Drive files to a Qdrant collection
     
     Parameters:
     - collection_name: String to be used as the collection name (will be sanitized)
     
     Returns:
-    - JSON with sync results including status, collection name, and statistics
+    - JSON with the job ID to poll at /jobs/{job_id}. A collection that is
+      already queued or syncing returns its current job instead of a new one.
     """
-    return await drive_app.run_sync(collection_name)
+    job = sync_jobs.submit(drive_app.sanitize_collection_name(collection_name))
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}")
+async def get_sync_job(job_id: str):
+    """
+    Status of a sync job
+    
+    Returns:
+    - JSON with the job status, listed/embedded/upserted progress counters,
+      and the sync results or error once it has finished
+    """
+    job = sync_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict()
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint"""
+    return {"status": "healthy"}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latency histograms, file and point counters, batch sizes, retries and in-flight requests, for Prometheus"""
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
 
 if __name__ == '__main__':
     import uvicorn
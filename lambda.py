@@ -1,18 +1,27 @@
 import os
 import json
+from collections import Counter
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
-import numpy as np
-import uuid
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from drive_source import SYNC_DELTA, SYNC_FULL, DriveChanges, get_start_page_token, iter_drive_files
+from embeddings import EMBED_WORKERS, get_embedding_backend
+from qdrant_store import (
+    DEDUP_SCAN, FILE_CHANGED, FILE_DELETED, FILE_NEW, FILE_REWRITTEN, FILE_UNCHANGED, UPSERT_BATCH_SIZE,
+    UPSERT_WORKERS, finish_sync, prepare_collection, sync_drive_files, sync_summary
+)
+from content_extraction import EXTRACT_CONTENT, EXTRACT_WORKERS, content_scopes
+
+# Lambda can only write under /tmp, which survives only while the container is warm.
+# Point this at a mounted EFS path to keep delta syncs across cold starts.
+SYNC_STATE_FILE = os.environ.get('DRIVE_SYNC_STATE_FILE', '/tmp/drive_sync_state.json')
 
 def init_google_client():
     """Initialize Google Drive client with service account"""
     creds_dict = json.loads(os.environ['GOOGLE_CREDENTIALS'])
     credentials = service_account.Credentials.from_service_account_info(
         creds_dict,
-        scopes=['https://www.googleapis.com/auth/drive.metadata.readonly']
+        scopes=content_scopes()
     )
     return build('drive', 'v3', credentials=credentials)
 
@@ -23,16 +32,12 @@ def init_qdrant_client():
         api_key=os.environ['QDRANT_API_KEY']
     )
 
-def generate_vector(file_name):
-    """Generate a deterministic vector based on filename"""
-    np.random.seed(hash(file_name) % (2**32))
-    return np.random.random(1536).tolist()
-
 def lambda_handler(event, context):
     try:
         # Initialize clients
         drive_service = init_google_client()
         qdrant_client = init_qdrant_client()
+        embedder = get_embedding_backend()
         
         # Get collection name from event
         collection_name = (
@@ -46,45 +51,49 @@ def lambda_handler(event, context):
         if not collection_name[0].isalpha():
             collection_name = 'c_' + collection_name
         
-        # Ensure collection exists
-        collections = qdrant_client.get_collections().collections
-        if not any(c.name == collection_name for c in collections):
-            qdrant_client.create_collection(
-                collection_name=collection_name,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
-            )
-        
-        # Get existing files
-        existing_points = qdrant_client.scroll(
-            collection_name=collection_name,
-            limit=10000,
-            with_payload=True
-        )[0]
-        existing_files = {point.payload["file_name"] for point in existing_points}
+        # Ensure collection exists, then get existing files or leave it to per-batch
+        # lookups during the insert. A delta sync starts from the saved page token.
+        delta = os.environ.get('SYNC_MODE', SYNC_FULL) == SYNC_DELTA
+        page_token, existing_files = prepare_collection(
+            qdrant_client,
+            collection_name,
+            embedder.size,
+            os.environ.get('DEDUP_MODE', DEDUP_SCAN),
+            SYNC_STATE_FILE if delta else None
+        )
         
-        # Fetch Drive files
-        results = drive_service.files().list(
-            pageSize=100,
-            fields="files(id, name)"
-        ).execute()
-        drive_files = results.get('files', [])
+        # Stream Drive files page by page, or only the changes since the saved page token
+        drive_changes = None
+        next_page_token = None
+        if page_token:
+            drive_changes = DriveChanges(drive_service, page_token)
+            drive_files = drive_changes
+        else:
+            if delta:
+                next_page_token = get_start_page_token(drive_service)
+            drive_files = iter_drive_files(drive_service)
         
-        # Process new files
-        new_points = []
-        for file in drive_files:
-            if file['name'] not in existing_files:
-                new_points.append(PointStruct(
-                    id=str(uuid.uuid4()),
-                    vector=generate_vector(file['name']),
-                    payload={"file_name": file['name']}
-                ))
+        # Stream new files to Qdrant in parallel batches
+        sync_counts = Counter()
+        sync_drive_files(
+            qdrant_client,
+            collection_name,
+            drive_files,
+            existing_files,
+            sync_counts,
+            embedder,
+            # Each extraction worker gets its own Drive client
+            service_factory=init_google_client if EXTRACT_CONTENT else None,
+            batch_size=int(os.environ.get('UPSERT_BATCH_SIZE', UPSERT_BATCH_SIZE)),
+            embed_workers=int(os.environ.get('EMBED_WORKERS', EMBED_WORKERS)),
+            upsert_workers=int(os.environ.get('UPSERT_WORKERS', UPSERT_WORKERS)),
+            extract_workers=int(os.environ.get('EXTRACT_WORKERS', EXTRACT_WORKERS))
+        )
         
-        # Insert new files
-        if new_points:
-            qdrant_client.upsert(
-                collection_name=collection_name,
-                points=new_points
-            )
+        # Remove files that are gone from Drive, then save the delta cursor
+        finish_sync(
+            qdrant_client, collection_name, existing_files, drive_changes, sync_counts, next_page_token, SYNC_STATE_FILE
+        )
         
         return {
             'statusCode': 200,
@@ -94,9 +103,13 @@ def lambda_handler(event, context):
             },
             'body': json.dumps({
                 'status': 'success',
-                'new_files_added': len(new_points),
+                'new_files_added': sync_counts[FILE_NEW],
+                'files_updated': sync_counts[FILE_CHANGED],
+                'files_unchanged': sync_counts[FILE_UNCHANGED],
+                'files_rewritten': sync_counts[FILE_REWRITTEN],
+                'files_deleted_in_drive': sync_counts[FILE_DELETED],
                 'collection_name': collection_name,
-                'message': f"Sync completed: {len(new_points)} new files added"
+                'message': f"Sync completed: {sync_summary(sync_counts)}"
             })
         }
     
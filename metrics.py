@@ -0,0 +1,160 @@
+# Process-wide counters, gauges and histograms, served by the FastAPI apps at
+# /metrics in the Prometheus text format. Updates are thread-safe, since
+# embedding and Google calls run on executor threads.
+import threading
+
+# Seconds, from a quick Qdrant call up to a full sync of a large Drive
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BATCH_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        if not self.labels:
+            # An unlabelled metric is reported as zero before its first update
+            self.values[()] = self._initial()
+        REGISTRY.append(self)
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {_number(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Cumulative buckets plus _sum and _count, as Prometheus expects"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=STAGE_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labels)
+
+    def _initial(self):
+        return [[0] * len(self.buckets), 0.0, 0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = self._initial()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        samples, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(f"{self.name}_bucket{self._label_text(key, [('le', _number(bound))])} {cumulative}")
+        samples.append(f"{self.name}_bucket{self._label_text(key, [('le', '+Inf')])} {count}")
+        samples.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+        samples.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return samples
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_metrics():
+    """Every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "drive_sync_stage_seconds", "Time spent in each stage of a sync", ("stage",)
+)
+SYNC_PROGRESS = Counter(
+    "drive_sync_progress_total", "Files listed from Drive, and points embedded and upserted", ("kind",)
+)
+SYNC_FILES = Counter(
+    "drive_sync_files_total", "Files by what a sync found: new, changed, unchanged, rewritten or deleted", ("status",)
+)
+SYNCS = Counter(
+    "drive_sync_syncs_total", "Finished syncs by result", ("result",)
+)
+UPSERT_BATCH_POINTS = Histogram(
+    "drive_sync_upsert_batch_points", "Points per Qdrant upsert request", buckets=BATCH_BUCKETS
+)
+RETRIES = Counter(
+    "drive_sync_retries_total", "Retried Qdrant upserts and embedding requests", ("operation",)
+)
+HTTP_IN_FLIGHT = Gauge(
+    "drive_sync_http_requests_in_flight", "HTTP requests being served"
+)
+UPSERTS_IN_FLIGHT = Gauge(
+    "drive_sync_qdrant_upserts_in_flight", "Qdrant upsert requests awaiting a response"
+)
+JOBS_RUNNING = Gauge(
+    "drive_sync_jobs_running", "Sync jobs being run by the job workers"
+)
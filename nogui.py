@@ -2,16 +2,24 @@ import os
 import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
 from google.auth.transport.requests import Request
-import numpy as np
-import uuid
 from dotenv import load_dotenv
 import time
+from collections import Counter
 from datetime import timedelta
-
-SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+from drive_source import (
+    DRIVE_SYNC_STATE_FILE, SYNC_DELTA, SYNC_FULL, DriveChanges, get_start_page_token, iter_drive_files
+)
+from embeddings import EMBED_WORKERS, get_embedding_backend
+from qdrant_store import (
+    DEDUP_SCAN, FILE_CHANGED, FILE_DELETED, FILE_NEW, FILE_REWRITTEN, FILE_UNCHANGED, UPSERT_BATCH_SIZE,
+    UPSERT_WORKERS, FileIndex, finish_sync, prepare_collection, sync_drive_files
+)
+from content_extraction import EXTRACT_CONTENT, EXTRACT_WORKERS, content_scopes
+
+SCOPES = content_scopes()
 load_dotenv()
 
 # OAuth configuration (replace with actual values)
@@ -41,6 +49,22 @@ class DriveToQdrantApp:
 
         # Timer variables
         self.operation_times = {}
+        self.drive_files_count = 0
+        self.sync_counts = Counter()
+        self.dedup_mode = os.getenv('DEDUP_MODE', DEDUP_SCAN)
+        self.upsert_batch_size = int(os.getenv('UPSERT_BATCH_SIZE', UPSERT_BATCH_SIZE))
+        self.upsert_workers = int(os.getenv('UPSERT_WORKERS', UPSERT_WORKERS))
+        self.embedder = get_embedding_backend()
+        self.embed_workers = int(os.getenv('EMBED_WORKERS', EMBED_WORKERS))
+        self.sync_mode = os.getenv('SYNC_MODE', SYNC_FULL)
+        self.sync_state_file = os.getenv('DRIVE_SYNC_STATE_FILE', DRIVE_SYNC_STATE_FILE)
+        # Changes cursor of the current sync: the stored one it starts from and the one to save after
+        self.page_token = None
+        self.next_page_token = None
+        self.drive_changes = None
+        self.drive_credentials = None
+        self.extract_content = EXTRACT_CONTENT
+        self.extract_workers = EXTRACT_WORKERS
 
     def format_time_delta(self, seconds):
         """Format time delta in a human-readable format"""
@@ -63,49 +87,22 @@ class DriveToQdrantApp:
             return duration
         return 0
 
-    def get_existing_files(self, collection_name):
-        """Get list of existing file names in the collection"""
-        self.start_timer("fetch_existing")
-        try:
-            points = self.qdrant.scroll(
-                collection_name=collection_name,
-                limit=10000,
-                with_payload=True,
-                with_vectors=False
-            )[0]
-            existing_files = {point.payload["file_name"] for point in points}
-            print(f"Fetched existing files in {self.format_time_delta(self.end_timer('fetch_existing'))}")
-            return existing_files
-        except Exception as e:
-            self.end_timer("fetch_existing")
-            print(f"Error fetching existing files: {e}")
-            return set()
-
     def handle_collection(self, collection_name):
         """Check if the collection exists, and create it if not."""
         self.start_timer("collection_handle")
         try:
-            collections = self.qdrant.get_collections().collections
-            exists = any(c.name == collection_name for c in collections)
-
-            if exists:
-                print(f"Collection exists. Fetching existing files...")
-                existing_files = self.get_existing_files(collection_name)
-                print(f"Collection check: {self.format_time_delta(self.end_timer('collection_handle'))}")
-                return True, existing_files
-
-            # Create the collection if it doesn't exist
-            self.qdrant.create_collection(
-                collection_name=collection_name,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
+            self.page_token, existing_files = prepare_collection(
+                self.qdrant, collection_name, self.embedder.size, self.dedup_mode,
+                self.sync_state_file if self.sync_mode == SYNC_DELTA else None
             )
-            print(f"Collection created in {self.format_time_delta(self.end_timer('collection_handle'))}")
-            return True, set()
+            print(f"Collection check: {self.format_time_delta(self.end_timer('collection_handle'))}")
+            return True, existing_files
 
         except Exception as e:
             self.end_timer("collection_handle")
+            self.page_token = None
             print(f"Collection handling error: {e}")
-            return False, set()
+            return False, FileIndex()
 
     def cleanup_token(self):
         """Remove the token file if it exists."""
@@ -126,6 +123,9 @@ class DriveToQdrantApp:
         if os.path.exists(token_file):
             with open(token_file, 'rb') as token:
                 creds = pickle.load(token)
+            # A token granted for other scopes, e.g. before content extraction was enabled, is dropped
+            if creds and not creds.has_scopes(SCOPES):
+                creds = None
 
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
@@ -140,59 +140,58 @@ class DriveToQdrantApp:
         print(f"Authentication: {self.format_time_delta(self.end_timer('auth'))}")
         return creds
 
+    def build_drive_service(self):
+        """Drive client for the signed-in user; each thread needs its own"""
+        return build('drive', 'v3', credentials=self.drive_credentials)
+
     def fetch_drive_files(self):
-        """Fetch a list of files from Google Drive."""
+        """Yield files from Google Drive page by page, or only the changed ones in delta mode."""
         self.start_timer("drive_fetch")
-        creds = self.google_auth()
-        service = build('drive', 'v3', credentials=creds)
-        results = service.files().list(
-            pageSize=10, fields="files(id, name)").execute()
-        items = results.get('files', [])
+        self.drive_files_count = 0
+        service = self.build_drive_service()
+        if self.page_token:
+            self.drive_changes = DriveChanges(service, self.page_token)
+            items = self.drive_changes
+        else:
+            self.drive_changes = None
+            # Taken before listing, so changes made during the listing are applied next time
+            self.next_page_token = get_start_page_token(service) if self.sync_mode == SYNC_DELTA else None
+            items = iter_drive_files(service)
+        for item in items:
+            self.drive_files_count += 1
+            yield item
 
         fetch_time = self.format_time_delta(self.end_timer('drive_fetch'))
         print(f"Drive fetch: {fetch_time}")
 
-        if not items:
+        if not self.drive_files_count and self.drive_changes is None:
             print("No files found.")
-            return []
-        return items
-
-    def generate_vector(self, file_name):
-        """Generate a random vector for a file name."""
-        np.random.seed(hash(file_name) % (2**32))
-        return np.random.random(1536).tolist()
 
     def insert_into_qdrant(self, files, collection_name, existing_files):
-        """Insert new files into the Qdrant collection."""
+        """Stream new files into the Qdrant collection in parallel batches."""
         self.start_timer("qdrant_insert")
-        points = []
-        new_files_count = 0
-
-        for file in files:
-            if file['name'] not in existing_files:
-                vector = self.generate_vector(file['name'])
-                point = PointStruct(
-                    id=str(uuid.uuid4()),
-                    vector=vector,
-                    payload={"file_name": file['name']}
-                )
-                points.append(point)
-                new_files_count += 1
-
-        if points:
-            try:
-                self.qdrant.upsert(
-                    collection_name=collection_name,
-                    points=points
-                )
-                print(f"Qdrant insert: {self.format_time_delta(self.end_timer('qdrant_insert'))}")
-                return True, new_files_count
-            except Exception as e:
-                self.end_timer("qdrant_insert")
-                print(f"Failed to sync to Qdrant: {e}")
-                return False, 0
-        self.end_timer("qdrant_insert")
-        return True, 0
+        self.sync_counts = Counter()
+        try:
+            upserted_count = sync_drive_files(
+                self.qdrant, collection_name, files, existing_files, self.sync_counts, self.embedder,
+                service_factory=self.build_drive_service if self.extract_content else None,
+                batch_size=self.upsert_batch_size, embed_workers=self.embed_workers,
+                upsert_workers=self.upsert_workers, extract_workers=self.extract_workers
+            )
+            finish_sync(
+                self.qdrant, collection_name, existing_files, self.drive_changes, self.sync_counts,
+                self.next_page_token, self.sync_state_file
+            )
+            print(f"Qdrant insert: {self.format_time_delta(self.end_timer('qdrant_insert'))}")
+            return True, upserted_count
+        except HttpError as e:
+            self.end_timer("qdrant_insert")
+            print(f"Failed to fetch files from Google Drive: {e}")
+            return False, 0
+        except Exception as e:
+            self.end_timer("qdrant_insert")
+            print(f"Failed to sync to Qdrant: {e}")
+            return False, 0
 
     def run(self):
         """Main workflow to handle syncing files from Google Drive to Qdrant."""
@@ -206,22 +205,36 @@ class DriveToQdrantApp:
             self.cleanup_token()
             return
 
+        try:
+            self.drive_credentials = self.google_auth()
+        except Exception as e:
+            print(f"Failed to authenticate with Google Drive: {e}")
+            self.cleanup_token()
+            return
+
         print("Fetching files from Google Drive...")
         try:
             files = self.fetch_drive_files()
-            if files:
-                print("Syncing to Qdrant...")
-                success, new_files_count = self.insert_into_qdrant(files, collection_name, existing_files)
-
-                total_time = self.format_time_delta(self.end_timer('total'))
-
-                if success:
-                    if new_files_count > 0:
-                        print(f"Sync completed in {total_time}: {new_files_count} new files added.")
-                    else:
-                        print("No new files to add.")
-                else:
-                    print("Sync failed.")
+            print("Syncing to Qdrant...")
+            success, upserted_count = self.insert_into_qdrant(files, collection_name, existing_files)
+            total_time = self.format_time_delta(self.end_timer('total'))
+
+            if not success:
+                print("Sync failed.")
+            elif not self.drive_files_count and not self.sync_counts[FILE_DELETED]:
+                if self.drive_changes is not None:
+                    print(f"No changes in Drive since the last sync ({total_time}).")
+            elif upserted_count > 0 or self.sync_counts[FILE_DELETED]:
+                print(
+                    f"Sync completed in {total_time}: "
+                    f"{self.sync_counts[FILE_NEW]} new files added, "
+                    f"{self.sync_counts[FILE_CHANGED]} changed files updated, "
+                    f"{self.sync_counts[FILE_UNCHANGED]} unchanged, "
+                    f"{self.sync_counts[FILE_REWRITTEN]} rewritten without dedup, "
+                    f"{self.sync_counts[FILE_DELETED]} deleted in Drive."
+                )
+            else:
+                print("No new files to add.")
         except Exception as e:
             print(f"Error syncing: {e}")
             self.cleanup_token()
@@ -0,0 +1,156 @@
+import datetime
+import hashlib
+import os
+import re
+
+NOTE_EXTENSION = ".md"
+FRONT_MATTER_RE = re.compile(r"\A---\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)", re.S)
+# [[Note]], [[Note|alias]], [[Note#Heading]] and embeds like ![[Note]]
+WIKILINK_RE = re.compile(r"!?\[\[([^\]|#^]*)(?:[#^][^\]|]*)?(?:\|[^\]]*)?\]\]")
+# Inline #tags; a tag needs at least one non-digit and cannot follow a word, so URLs are skipped
+TAG_RE = re.compile(r"(?<![\w/&#])#([\w/-]*[^\W\d][\w/-]*)")
+CODE_RE = re.compile(r"```.*?```|~~~.*?~~~|`[^`\n]*`", re.S)
+
+
+def scan_vault(vault):
+    """Yield (path relative to the vault, mtime_ns, size) for every note.
+
+    Walks the vault with os.scandir and skips hidden entries, which covers
+    .obsidian, .trash and .git. Paths use forward slashes on every platform.
+    """
+    stack = [vault]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(NOTE_EXTENSION) and entry.is_file():
+                    stat = entry.stat()
+                    path = os.path.relpath(entry.path, vault).replace(os.sep, '/')
+                    yield path, stat.st_mtime_ns, stat.st_size
+
+
+def note_hash(raw):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def diff_vault(vault, manifest):
+    """Compare a vault with its manifest of path -> [mtime_ns, size, hash].
+
+    Returns (changed, removed, new_manifest). changed holds (path, raw
+    bytes) for new and edited notes, removed the paths that are gone. A
+    note whose mtime and size match the manifest is not opened at all, and
+    one that was only touched is re-hashed but not reported as changed.
+    """
+    changed, new_manifest = [], {}
+    for path, mtime_ns, size in scan_vault(vault):
+        entry = manifest.get(path)
+        if entry and entry[0] == mtime_ns and entry[1] == size:
+            new_manifest[path] = entry
+            continue
+        with open(os.path.join(vault, path), 'rb') as f:
+            raw = f.read()
+        digest = note_hash(raw)
+        new_manifest[path] = [mtime_ns, size, digest]
+        if not entry or entry[2] != digest:
+            changed.append((path, raw))
+    removed = [path for path in manifest if path not in new_manifest]
+    return changed, removed, new_manifest
+
+
+def parse_front_matter(text):
+    """Split a note into (front-matter dict, body)"""
+    match = FRONT_MATTER_RE.match(text)
+    if not match:
+        return {}, text
+    body = text[match.end():]
+    try:
+        import yaml
+        data = yaml.safe_load(match.group(1))
+    except ImportError:
+        data = _simple_front_matter(match.group(1))
+    except Exception:
+        # Broken YAML is left in the body as plain text
+        return {}, text
+    return (data if isinstance(data, dict) else {}), body
+
+
+def _simple_front_matter(block):
+    """key: value and "- item" lists, for when PyYAML is not installed"""
+    data, key = {}, None
+    for line in block.splitlines():
+        if line.lstrip().startswith('- ') and key:
+            if not isinstance(data.get(key), list):
+                data[key] = []
+            data[key].append(line.lstrip()[2:].strip().strip('"\''))
+        elif ':' in line and not line.startswith((' ', '\t')):
+            key, value = line.split(':', 1)
+            key, value = key.strip(), value.strip()
+            if value.startswith('[') and value.endswith(']'):
+                value = [item.strip().strip('"\'') for item in value[1:-1].split(',') if item.strip()]
+            data[key] = value.strip('"\'') if isinstance(value, str) else value
+    return data
+
+
+def _as_list(value, split=False):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        # Tags may be written as one space or comma separated string
+        return [item for item in re.split(r"[,\s]+", value) if item] if split else [value]
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value if item is not None]
+    return [str(value)]
+
+
+def _payload_front_matter(front_matter):
+    """Only JSON-friendly scalars go into the payload; YAML dates become ISO strings"""
+    fields = {}
+    for key, value in front_matter.items():
+        if isinstance(value, (datetime.date, datetime.time)):
+            value = value.isoformat()
+        if isinstance(value, (str, int, float, bool)) or value is None:
+            fields[str(key)] = value
+    return fields
+
+
+def parse_note(path, raw):
+    """Parse a note into its title, body text, tags, wikilinks and front-matter"""
+    text = raw.decode('utf-8', errors='replace').lstrip('\ufeff')
+    front_matter, body = parse_front_matter(text)
+    plain = CODE_RE.sub(" ", body)
+    tags = [tag.lstrip('#') for tag in _as_list(front_matter.get('tags') or front_matter.get('tag'), split=True)]
+    tags += TAG_RE.findall(plain)
+    links = [link.strip() for link in WIKILINK_RE.findall(plain) if link.strip()]
+    title = os.path.splitext(os.path.basename(path))[0]
+    return {
+        "path": path,
+        "title": str(front_matter.get('title') or title),
+        "aliases": _as_list(front_matter.get('aliases') or front_matter.get('alias')),
+        "tags": list(dict.fromkeys(tags)),
+        "links": list(dict.fromkeys(links)),
+        "front_matter": _payload_front_matter(front_matter),
+        "body": body.strip(),
+    }
+
+
+def note_text(note):
+    """Text that represents a note for embedding: its title, then its body"""
+    return f"{note['title']}\n\n{note['body']}" if note['body'] else note['title']
+
+
+def note_payload(note, chunk_index, text):
+    """Qdrant payload for one chunk of a note; file_id is the note's vault path"""
+    return {
+        "file_id": note["path"],
+        "title": note["title"],
+        "aliases": note["aliases"],
+        "tags": note["tags"],
+        "links": note["links"],
+        "front_matter": note["front_matter"],
+        "chunk_index": chunk_index,
+        "text": text,
+    }
@@ -0,0 +1,545 @@
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from qdrant_client.http.models import (
+    Batch, Distance, FieldCondition, Filter, FilterSelector, MatchAny, MatchValue, PayloadSchemaType, PointIdsList,
+    Range, VectorParams
+)
+from chunking import chunk_text
+from content_extraction import EXTRACT_WORKERS, extract_contents
+from drive_source import (
+    FINGERPRINT_FIELDS, drive_chunk_payload, drive_file_payload, drive_file_text, file_fingerprint, index_settings
+)
+from embeddings import EMBED_WORKERS, embed_batches
+from metrics import RETRIES
+from sync_state import load_sync_state, save_sync_state
+from tracing import in_current_context, span
+
+SCROLL_PAGE_SIZE = 10000
+LOOKUP_BATCH_SIZE = 256
+UPSERT_RETRIES = 3
+UPSERT_RETRY_BACKOFF = 1.0
+# Points per upsert request and number of requests in flight at once
+UPSERT_BATCH_SIZE = 256
+UPSERT_WORKERS = 4
+# Point IDs or file IDs per delete request
+DELETE_BATCH_SIZE = 1000
+
+# Dedup modes: "scan" pulls every point's fingerprint into a local index
+# before the sync, "lookup" asks Qdrant about each batch of Drive files
+# instead and "none" skips dedup and re-upserts every file, counting it as
+# rewritten. Point IDs are derived from the Drive file ID, so re-upserting a
+# file overwrites its point in place.
+DEDUP_SCAN = "scan"
+DEDUP_LOOKUP = "lookup"
+DEDUP_NONE = "none"
+
+# How a Drive file compares to what the collection holds for it
+FILE_NEW = "new"
+FILE_CHANGED = "changed"
+FILE_UNCHANGED = "unchanged"
+FILE_DELETED = "deleted"
+# Written again without comparing, when dedup is off
+FILE_REWRITTEN = "rewritten"
+
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://drive.google.com/")
+
+
+def drive_point_id(file_id):
+    """Deterministic point ID for a Drive file ID"""
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, file_id))
+
+
+def chunk_point_id(file_id, chunk_index):
+    """Deterministic point ID for a chunk of a Drive file.
+
+    The first chunk keeps the file's own point ID, so change detection only
+    ever looks at one point per file.
+    """
+    if chunk_index == 0:
+        return drive_point_id(file_id)
+    return drive_point_id(f"{file_id}#{chunk_index}")
+
+
+def point_id_halves(point_id):
+    """Split a UUID point ID into its high and low 64 bits"""
+    value = uuid.UUID(str(point_id)).int
+    return value >> 64, value & 0xFFFFFFFFFFFFFFFF
+
+
+class FileIndex:
+    """Compact map of point ID to content fingerprint for a whole collection.
+
+    Only the first chunk of each file is indexed. Point IDs are kept as two
+    sorted uint64 columns next to a uint64 fingerprint column, about 24
+    bytes per file, so a million files fit in roughly 24MB. Every lookup
+    marks the point as seen, which lets the sync list the points whose
+    file is gone from Drive afterwards.
+    """
+
+    def __init__(self, hi=None, lo=None, fingerprints=None):
+        empty = np.empty(0, dtype=np.uint64)
+        hi = np.asarray(hi if hi is not None else empty, dtype=np.uint64)
+        lo = np.asarray(lo if lo is not None else empty, dtype=np.uint64)
+        fingerprints = np.asarray(fingerprints if fingerprints is not None else empty, dtype=np.uint64)
+        order = np.lexsort((lo, hi))
+        self.hi, self.lo, self.fingerprints = hi[order], lo[order], fingerprints[order]
+        self.seen = np.zeros(len(self.hi), dtype=bool)
+
+    def find(self, point_id):
+        """Position of point_id in the index, or -1"""
+        hi, lo = point_id_halves(point_id)
+        i = int(np.searchsorted(self.hi, np.uint64(hi)))
+        while i < len(self.hi) and self.hi[i] == hi:
+            if self.lo[i] == lo:
+                return i
+            i += 1
+        return -1
+
+    def classify(self, file, settings=None):
+        """Classify a Drive file as new, changed or unchanged, marking its point as seen.
+
+        A file stored with other index settings counts as changed.
+        """
+        i = self.find(drive_point_id(file['id']))
+        if i < 0:
+            return FILE_NEW
+        self.seen[i] = True
+        if self.fingerprints[i] != file_fingerprint(drive_file_payload(file, settings)):
+            return FILE_CHANGED
+        return FILE_UNCHANGED
+
+    def deleted_count(self):
+        return int(len(self.seen) - np.count_nonzero(self.seen))
+
+    def deleted_point_ids(self):
+        """IDs of points that no classified Drive file matched"""
+        unseen = np.flatnonzero(~self.seen)
+        return [str(uuid.UUID(int=(int(self.hi[i]) << 64) | int(self.lo[i]))) for i in unseen]
+
+    def __len__(self):
+        return len(self.hi)
+
+
+class RewriteIndex:
+    """Stands in for a FileIndex when dedup is off: every file is rewritten and none counts as deleted"""
+
+    def classify(self, file, settings=None):
+        return FILE_REWRITTEN
+
+    def deleted_count(self):
+        return 0
+
+    def deleted_point_ids(self):
+        return []
+
+    def __len__(self):
+        return 0
+
+
+def iter_existing_pages(qdrant, collection_name, page_size=SCROLL_PAGE_SIZE):
+    """Yield pages of points with their fingerprint fields, following the scroll cursor"""
+    offset = None
+    while True:
+        points, offset = qdrant.scroll(
+            collection_name=collection_name,
+            limit=page_size,
+            offset=offset,
+            with_payload=FINGERPRINT_FIELDS + ["chunk_index"],
+            with_vectors=False
+        )
+        yield points
+        if offset is None:
+            break
+
+
+def index_columns(points):
+    """(hi, lo, fingerprint) arrays for the indexable points of one scroll page"""
+    # Integer IDs were never written by this tool, and later chunks share
+    # the first chunk's fingerprint, so both are skipped
+    points = [
+        point for point in points
+        if not isinstance(point.id, int) and not (point.payload or {}).get("chunk_index")
+    ]
+    halves = [point_id_halves(point.id) for point in points]
+    return (
+        np.fromiter((h for h, _ in halves), dtype=np.uint64, count=len(halves)),
+        np.fromiter((l for _, l in halves), dtype=np.uint64, count=len(halves)),
+        np.fromiter((file_fingerprint(point.payload or {}) for point in points), dtype=np.uint64, count=len(points)),
+    )
+
+
+def file_index_from_columns(columns):
+    """Merge per-page index columns into one FileIndex"""
+    if not columns:
+        return FileIndex()
+    his, los, fingerprints = zip(*columns)
+    return FileIndex(np.concatenate(his), np.concatenate(los), np.concatenate(fingerprints))
+
+
+def build_file_index(qdrant, collection_name, page_size=SCROLL_PAGE_SIZE):
+    """Scan the whole collection into a FileIndex"""
+    return file_index_from_columns([
+        index_columns(points) for points in iter_existing_pages(qdrant, collection_name, page_size)
+    ])
+
+
+def iter_batches(items, batch_size):
+    """Group any iterable into lists of at most batch_size items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ensure_file_id_index(qdrant, collection_name):
+    """Create the keyword payload index used to select a file's points"""
+    qdrant.create_payload_index(
+        collection_name=collection_name,
+        field_name="file_id",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+
+
+def check_vector_size(collection_name, vectors_config, vector_size):
+    """Raise ValueError if a collection holds vectors of another size than the embedder makes"""
+    size = getattr(vectors_config, 'size', None)
+    if size is not None and size != vector_size:
+        raise ValueError(
+            f"Collection {collection_name} holds {size}-dimensional vectors but the embedding backend makes "
+            f"{vector_size}-dimensional ones; set EMBEDDING_BACKEND and VECTOR_SIZE to match it, "
+            f"or sync into a new collection"
+        )
+
+
+def prepare_collection(qdrant, collection_name, vector_size, dedup_mode=DEDUP_SCAN, sync_state_file=None):
+    """Create the collection if it is missing and work out how this sync finds the stored files.
+
+    An existing collection must hold vectors of vector_size, otherwise
+    ValueError is raised before anything is embedded.
+
+    Returns (page_token, existing_files). The page token saved in
+    sync_state_file is only used for a collection that exists; pass None
+    for a full sync. existing_files is the FileIndex to classify Drive
+    files against, or None when each batch of files is looked up in Qdrant
+    instead, as in lookup mode and in a delta sync, which only lists the
+    files that changed.
+    """
+    collections = qdrant.get_collections().collections
+    if not any(c.name == collection_name for c in collections):
+        qdrant.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
+        )
+        ensure_file_id_index(qdrant, collection_name)
+        return None, FileIndex()
+
+    check_vector_size(collection_name, qdrant.get_collection(collection_name).config.params.vectors, vector_size)
+    # Collections from before the index existed get it too; creating it again is a no-op
+    ensure_file_id_index(qdrant, collection_name)
+    # A token saved for a collection that no longer exists is ignored
+    page_token = load_sync_state(sync_state_file).get(collection_name) if sync_state_file else None
+    if page_token or dedup_mode == DEDUP_LOOKUP:
+        return page_token, None
+    if dedup_mode == DEDUP_NONE:
+        # Upserts are idempotent, so every file is simply written again
+        return None, RewriteIndex()
+    return None, build_file_index(qdrant, collection_name)
+
+
+def fetch_fingerprints(qdrant, collection_name, point_ids):
+    """Map each stored point in point_ids to its fingerprint"""
+    with span("qdrant.lookup", points=len(point_ids)):
+        records = qdrant.retrieve(
+            collection_name=collection_name,
+            ids=point_ids,
+            with_payload=FINGERPRINT_FIELDS,
+            with_vectors=False
+        )
+    return {str(record.id): file_fingerprint(record.payload or {}) for record in records}
+
+
+def lookup_status(file, stored_fingerprint, settings=None):
+    """Classify a Drive file against the fingerprint stored for it, None if it has no point"""
+    if stored_fingerprint is None:
+        return FILE_NEW
+    if stored_fingerprint != file_fingerprint(drive_file_payload(file, settings)):
+        return FILE_CHANGED
+    return FILE_UNCHANGED
+
+
+def select_changed_files(qdrant, collection_name, files, index, counts, batch_size=LOOKUP_BATCH_SIZE, settings=None):
+    """Yield the Drive files that are new or changed, tallying every status in counts.
+
+    Files are compared as indexed with the given index settings, and each
+    one is yielded with its status in a 'sync_status' field. With an index
+    the files are classified locally and, once the listing is exhausted,
+    points no file matched are counted as deleted. Without one (lookup
+    mode) each batch of candidates is checked with a retrieve call;
+    deletions cannot be detected that way.
+    """
+    if index is not None:
+        for file in files:
+            status = index.classify(file, settings)
+            counts[status] += 1
+            if status != FILE_UNCHANGED:
+                yield dict(file, sync_status=status)
+        counts[FILE_DELETED] += index.deleted_count()
+        return
+
+    for batch in iter_batches(files, batch_size):
+        point_ids = [drive_point_id(file['id']) for file in batch]
+        stored = fetch_fingerprints(qdrant, collection_name, point_ids)
+        for file, point_id in zip(batch, point_ids):
+            status = lookup_status(file, stored.get(point_id), settings)
+            counts[status] += 1
+            if status != FILE_UNCHANGED:
+                yield dict(file, sync_status=status)
+
+
+class StaleChunks:
+    """New chunk counts of re-embedded files, to delete the chunks they no longer have.
+
+    A file whose text got shorter keeps points past its new last chunk.
+    Those are deleted only once the batch holding the file's last new chunk
+    is stored, so the file never disappears from the collection midway.
+    Batches are stored in order, so by then all of its chunks are written.
+    """
+
+    def __init__(self):
+        self.chunk_counts = {}
+
+    def track(self, file_id, chunk_count):
+        if chunk_count:
+            self.chunk_counts[file_id] = chunk_count
+
+    def finished(self, batch):
+        """{file_id: chunk count} of the tracked files whose last chunk is in a stored batch"""
+        finished = {}
+        for payload in batch.payloads:
+            chunk_count = self.chunk_counts.get(payload['file_id'])
+            if chunk_count is not None and payload['chunk_index'] == chunk_count - 1:
+                finished[payload['file_id']] = self.chunk_counts.pop(payload['file_id'])
+        return finished
+
+
+def iter_file_chunks(files, stale_chunks=None):
+    """Lazily yield (file, chunk_index, text) for every chunk of every file.
+
+    Files that already had points, i.e. any not classified as new, get
+    their chunk count tracked in stale_chunks when one is given.
+    """
+    for file in files:
+        texts = list(chunk_text(drive_file_text(file)))
+        if stale_chunks is not None and file.get('sync_status') != FILE_NEW:
+            stale_chunks.track(file['id'], len(texts))
+        for chunk_index, text in enumerate(texts):
+            yield file, chunk_index, text
+
+
+def point_batches(chunks, embedder, batch_size=UPSERT_BATCH_SIZE, workers=EMBED_WORKERS, settings=None):
+    """Lazily embed (file, chunk_index, text) chunks into Batch objects of at most batch_size points"""
+    chunk_batches = iter_batches(chunks, batch_size)
+    for batch, vectors in embed_batches(embedder, chunk_batches, lambda chunk: chunk[2], workers):
+        yield Batch(
+            ids=[chunk_point_id(file['id'], chunk_index) for file, chunk_index, _ in batch],
+            vectors=vectors.tolist(),
+            payloads=[drive_chunk_payload(file, chunk_index, text, settings) for file, chunk_index, text in batch]
+        )
+
+
+def file_point_batches(files, embedder, batch_size=UPSERT_BATCH_SIZE, workers=EMBED_WORKERS,
+                       service_factory=None, extract_workers=EXTRACT_WORKERS, stale_chunks=None):
+    """Lazily extract, chunk and embed a batch of files into Batch objects; each step blocks.
+
+    Content is extracted only when a service_factory for Drive clients is
+    given. Chunk counts of files that already had points are tracked in
+    stale_chunks when one is given.
+    """
+    settings = index_settings(embedder.cache_key, service_factory is not None)
+    if service_factory is not None:
+        files = extract_contents(files, service_factory, extract_workers)
+    return point_batches(iter_file_chunks(files, stale_chunks), embedder, batch_size, workers, settings)
+
+
+def sync_drive_files(qdrant, collection_name, files, existing_files, counts, embedder, service_factory=None,
+                     batch_size=UPSERT_BATCH_SIZE, embed_workers=EMBED_WORKERS, upsert_workers=UPSERT_WORKERS,
+                     extract_workers=EXTRACT_WORKERS, on_stored=None):
+    """Stream the new and changed Drive files into the collection, tallying every status in counts.
+
+    Listing, extraction, embedding and uploads all overlap. Content is
+    extracted only when a service_factory for Drive clients is given. A
+    changed file's leftover chunks are deleted after its new ones are
+    stored. Returns the number of points written.
+    """
+    settings = index_settings(embedder.cache_key, service_factory is not None)
+    changed_files = select_changed_files(qdrant, collection_name, files, existing_files, counts, settings=settings)
+    if service_factory is not None:
+        changed_files = extract_contents(changed_files, service_factory, extract_workers)
+    stale_chunks = StaleChunks()
+
+    def stored(batch):
+        delete_stale_chunks(qdrant, collection_name, stale_chunks.finished(batch))
+        if on_stored is not None:
+            on_stored(batch)
+
+    chunks = iter_file_chunks(changed_files, stale_chunks)
+    return upsert_batches(
+        qdrant, collection_name, point_batches(chunks, embedder, batch_size, embed_workers, settings),
+        upsert_workers, stored
+    )
+
+
+def upsert_with_retry(qdrant, collection_name, points, retries=UPSERT_RETRIES, backoff=UPSERT_RETRY_BACKOFF):
+    """Upsert points, retrying with exponential backoff.
+
+    Retrying is safe because point IDs are deterministic: a batch that was
+    partly applied before the failure is simply overwritten.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return qdrant.upsert(collection_name=collection_name, points=points)
+        except Exception:
+            if attempt == retries:
+                raise
+            RETRIES.inc(operation="qdrant_upsert")
+            time.sleep(backoff * 2 ** attempt)
+
+
+def upsert_batches(qdrant, collection_name, batches, workers=UPSERT_WORKERS, on_stored=None):
+    """Upsert Batch objects as they are produced, on a pool of upload workers.
+
+    Building the next batch overlaps with uploading the previous ones. At
+    most `workers` batches are in flight, so memory stays bounded by
+    (workers + 1) * batch size points. Each batch is retried on its own.
+    Batches are collected oldest first, so on_stored(batch) is called in
+    production order and can safely advance a resume cursor.
+    Returns the number of points written.
+    """
+    upserted = 0
+    in_flight = deque()
+
+    def collect_oldest():
+        batch, future = in_flight.popleft()
+        count = future.result()
+        if on_stored is not None:
+            on_stored(batch)
+        return count
+
+    upsert_batch = in_current_context(_upsert_batch)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            if len(in_flight) >= workers:
+                upserted += collect_oldest()
+            in_flight.append((batch, executor.submit(upsert_batch, qdrant, collection_name, batch)))
+        while in_flight:
+            upserted += collect_oldest()
+    return upserted
+
+
+def _upsert_batch(qdrant, collection_name, batch):
+    with span("qdrant.upsert", points=len(batch.ids)):
+        upsert_with_retry(qdrant, collection_name, batch)
+    return len(batch.ids)
+
+
+def delete_points(qdrant, collection_name, point_ids, batch_size=DELETE_BATCH_SIZE):
+    """Delete points by ID, at most batch_size IDs per request. Returns the number of IDs sent"""
+    deleted = 0
+    for batch in iter_batches(point_ids, batch_size):
+        qdrant.delete(collection_name=collection_name, points_selector=PointIdsList(points=batch))
+        deleted += len(batch)
+    return deleted
+
+
+def delete_indexed_files(qdrant, collection_name, point_ids, batch_size=DELETE_BATCH_SIZE):
+    """Delete every chunk of the files whose first-chunk point IDs are given. Returns the number of files"""
+    deleted = 0
+    for batch in iter_batches(point_ids, batch_size):
+        records = qdrant.retrieve(
+            collection_name=collection_name, ids=batch, with_payload=["file_id"], with_vectors=False
+        )
+        file_ids = [record.payload["file_id"] for record in records if (record.payload or {}).get("file_id")]
+        delete_file_points(qdrant, collection_name, file_ids, batch_size)
+        # Points without a file_id cannot have chunks, so deleting them by ID is enough
+        unkeyed = [record.id for record in records if not (record.payload or {}).get("file_id")]
+        delete_points(qdrant, collection_name, unkeyed, batch_size)
+        deleted += len(batch)
+    return deleted
+
+
+def delete_file_points(qdrant, collection_name, file_ids, batch_size=DELETE_BATCH_SIZE):
+    """Delete every point whose file_id is in file_ids, at most batch_size file IDs per request.
+
+    Selecting by the indexed file_id payload catches all points stored for
+    a file, not only the one its point ID was derived from. Returns the
+    number of file IDs sent.
+    """
+    deleted = 0
+    for batch in iter_batches(file_ids, batch_size):
+        with span("qdrant.delete", files=len(batch)):
+            qdrant.delete(
+                collection_name=collection_name,
+                points_selector=FilterSelector(
+                    filter=Filter(must=[FieldCondition(key="file_id", match=MatchAny(any=batch))])
+                )
+            )
+        deleted += len(batch)
+    return deleted
+
+
+def stale_chunks_filter(chunk_counts):
+    """Filter matching the points of each file_id from its chunk count on"""
+    return Filter(should=[
+        Filter(must=[
+            FieldCondition(key="file_id", match=MatchValue(value=file_id)),
+            FieldCondition(key="chunk_index", range=Range(gte=chunk_count)),
+        ])
+        for file_id, chunk_count in chunk_counts.items()
+    ])
+
+
+def delete_stale_chunks(qdrant, collection_name, chunk_counts):
+    """Delete the chunks past each file's new chunk count, in one request"""
+    if not chunk_counts:
+        return
+    with span("qdrant.delete_stale", files=len(chunk_counts)):
+        qdrant.delete(
+            collection_name=collection_name,
+            points_selector=FilterSelector(filter=stale_chunks_filter(chunk_counts))
+        )
+
+
+def finish_sync(qdrant, collection_name, existing_files, drive_changes, counts, next_page_token=None,
+                sync_state_file=None):
+    """Delete the points of files that are gone from Drive and save the page token the next delta sync starts from.
+
+    A delta sync deletes the files its Changes listing reported as removed
+    and takes the new token from it; a full sync deletes every indexed file
+    its listing did not match. Returns the token that was saved, if any.
+    """
+    if drive_changes is not None:
+        counts[FILE_DELETED] += delete_file_points(qdrant, collection_name, drive_changes.removed_file_ids)
+        next_page_token = drive_changes.new_start_page_token
+    elif existing_files is not None:
+        # The full listing has been consumed, so every point it did not match is stale
+        delete_indexed_files(qdrant, collection_name, existing_files.deleted_point_ids())
+    if next_page_token and sync_state_file:
+        sync_state = load_sync_state(sync_state_file)
+        sync_state[collection_name] = next_page_token
+        save_sync_state(sync_state, sync_state_file)
+    return next_page_token
+
+
+def sync_summary(counts):
+    """Short summary of a sync's file counts for status messages"""
+    summary = f"{counts[FILE_NEW]} new files added, {counts[FILE_CHANGED]} updated"
+    if counts[FILE_REWRITTEN]:
+        summary += f", {counts[FILE_REWRITTEN]} rewritten"
+    return summary
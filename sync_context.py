@@ -0,0 +1,52 @@
+# State of a single sync for the FastAPI apps. DriveToQdrantApp keeps the
+# configuration and the shared clients; everything one sync changes lives here,
+# so concurrent syncs never see each other's timers, counts or page tokens.
+import time
+from collections import Counter
+from metrics import STAGE_SECONDS, SYNC_FILES, SYNC_PROGRESS, SYNCS
+
+
+class SyncContext:
+    """Timers, counters, dedup and Drive changes state of one sync of one collection"""
+
+    def __init__(self, collection_name, progress=None):
+        self.collection_name = collection_name
+        # Live listed/embedded/upserted counts, shared with the job that runs the sync
+        self.progress = Counter() if progress is None else progress
+        self.operation_times = {}
+        self.durations = {}
+        self.drive_files_count = 0
+        self.sync_counts = Counter()
+        # FileIndex of the stored files, or None when each file is looked up in Qdrant
+        self.existing_files = None
+        # Changes cursor: the stored one the sync starts from and the one to save after
+        self.page_token = None
+        self.next_page_token = None
+        self.drive_changes = None
+        self.drive_credentials = None
+
+    def start_timer(self, operation):
+        self.operation_times[operation] = time.perf_counter()
+
+    def end_timer(self, operation):
+        """Stop a timer and return its duration in seconds.
+
+        durations adds up the time of a stage that runs several times, like
+        embed, and every run is observed in the stage latency histogram.
+        """
+        if operation in self.operation_times:
+            duration = time.perf_counter() - self.operation_times.pop(operation)
+            self.durations[operation] = self.durations.get(operation, 0) + duration
+            STAGE_SECONDS.observe(duration, stage=operation)
+            return duration
+        return 0
+
+    def add_progress(self, kind, count=1):
+        self.progress[kind] += count
+        SYNC_PROGRESS.inc(count, kind=kind)
+
+    def record_result(self, succeeded):
+        """Add this sync's file counts and outcome to the process-wide metrics"""
+        for status, count in self.sync_counts.items():
+            SYNC_FILES.inc(count, status=status)
+        SYNCS.inc(result="success" if succeeded else "error")
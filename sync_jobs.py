@@ -0,0 +1,137 @@
+# In-process job queue for the FastAPI apps: /sync enqueues a job and returns
+# at once, a fixed number of workers run the syncs, and /jobs/{id} reports on them.
+import asyncio
+import os
+import time
+import uuid
+from collections import Counter, OrderedDict
+from metrics import JOBS_RUNNING
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+# Progress counters every job reports, even before they are first incremented
+PROGRESS_LISTED = "listed"
+PROGRESS_EMBEDDED = "embedded"
+PROGRESS_UPSERTED = "upserted"
+# Syncs that may run at the same time
+SYNC_JOB_WORKERS = int(os.getenv('SYNC_JOB_WORKERS', 2))
+# Finished jobs kept for polling; the oldest are forgotten first
+JOB_HISTORY = int(os.getenv('JOB_HISTORY', 1000))
+
+
+class SyncJob:
+    """One requested sync of a collection and what is known about its progress"""
+
+    def __init__(self, collection_name):
+        self.id = uuid.uuid4().hex
+        self.collection_name = collection_name
+        self.status = JOB_QUEUED
+        self.progress = Counter({PROGRESS_LISTED: 0, PROGRESS_EMBEDDED: 0, PROGRESS_UPSERTED: 0})
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "collection_name": self.collection_name,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class SyncJobQueue:
+    """Run sync jobs on a bounded pool of asyncio workers.
+
+    run_job(job) is awaited for each job and its return value becomes the
+    job's result; it should add to job.progress as it goes. A collection has
+    at most one queued or running job, so submitting it again returns the
+    job already in flight. Workers start on the first submit, inside the
+    running event loop.
+    """
+
+    def __init__(self, run_job, workers=SYNC_JOB_WORKERS, history=JOB_HISTORY):
+        self.run_job = run_job
+        self.workers = workers
+        self.history = history
+        self.jobs = OrderedDict()
+        self.active = {}
+        self.queue = None
+        self.tasks = []
+
+    def submit(self, collection_name):
+        """Queue a sync of collection_name, or return the one already queued or running"""
+        if collection_name in self.active:
+            return self.active[collection_name]
+        self.start()
+        job = SyncJob(collection_name)
+        self.jobs[job.id] = job
+        self.active[collection_name] = job
+        self.queue.put_nowait(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    async def wait(self, job_id):
+        """Wait for a job to finish and return it"""
+        job = self.jobs[job_id]
+        await job.done.wait()
+        return job
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Cancel the workers and fail the jobs still waiting in the queue"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        while self.queue is not None and not self.queue.empty():
+            job = self.queue.get_nowait()
+            job.status = JOB_FAILED
+            job.error = "Cancelled"
+            self._finish(job)
+        self.tasks = []
+        self.queue = None
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+            JOBS_RUNNING.inc()
+            try:
+                job.result = await self.run_job(job)
+                job.status = JOB_SUCCEEDED
+            except asyncio.CancelledError:
+                job.status = JOB_FAILED
+                job.error = "Cancelled"
+                raise
+            except Exception as e:
+                job.status = JOB_FAILED
+                # HTTPException carries its message in detail
+                job.error = getattr(e, 'detail', None) or str(e)
+            finally:
+                JOBS_RUNNING.dec()
+                self._finish(job)
+
+    def _finish(self, job):
+        job.finished_at = time.time()
+        del self.active[job.collection_name]
+        job.done.set()
+        finished = [job_id for job_id, other in self.jobs.items() if other.done.is_set()]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
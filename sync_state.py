@@ -0,0 +1,18 @@
+import json
+import os
+
+
+def load_sync_state(path):
+    """Load a JSON sync-state file, or an empty state if it does not exist yet"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_sync_state(state, path):
+    """Write the sync state atomically so a crash never leaves a torn file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
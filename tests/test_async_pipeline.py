@@ -0,0 +1,46 @@
+import asyncio
+from collections import Counter
+from qdrant_client import AsyncQdrantClient
+import async_qdrant_store
+from embeddings import FakeBackend
+from qdrant_store import FILE_NEW, file_point_batches
+
+
+async def aiter_list(items):
+    for item in items:
+        yield item
+
+
+def drive_file(file_id, words):
+    return {"id": file_id, "name": " ".join(f"{file_id}-word{i}" for i in range(words)), "version": "1"}
+
+
+def test_batches_stream_from_the_embedder_with_bounded_lookahead():
+    async def scenario():
+        qdrant = AsyncQdrantClient(":memory:")
+        _, existing_files = await async_qdrant_store.prepare_collection(qdrant, "docs", 8)
+        embedder = FakeBackend(8)
+        built, stored, lookahead = [], [], []
+
+        async def embed_files(files, stale_chunks):
+            for batch in file_point_batches(files, embedder, batch_size=4, workers=1, stale_chunks=stale_chunks):
+                built.append(batch)
+                yield batch
+
+        def on_stored(batch):
+            stored.append(batch)
+            lookahead.append(len(built) - len(stored))
+
+        files = [drive_file(f"f{i}", 400) for i in range(6)]
+        counts = Counter()
+        upserted = await async_qdrant_store.sync_drive_files(
+            qdrant, "docs", aiter_list(files), existing_files, counts, embed_files, batch_size=3, workers=2,
+            on_stored=on_stored
+        )
+        assert counts[FILE_NEW] == 6
+        assert upserted == (await qdrant.count("docs")).count == sum(len(batch.ids) for batch in built)
+        assert len(built) > 6
+        # Never more than the in-flight upserts plus the batch waiting for a slot
+        assert max(lookahead) <= 2 + 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,45 @@
+import pytest
+from chunking import chunk_text
+
+
+def test_short_text_is_one_chunk():
+    assert list(chunk_text("A short note.", 200, 40)) == ["A short note."]
+
+
+def test_empty_text_has_no_chunks():
+    assert list(chunk_text("", 200, 40)) == []
+    assert list(chunk_text("   \n\n ", 200, 40)) == []
+
+
+def test_chunks_respect_the_size_and_cover_the_text():
+    text = "Para one is here. It has sentences.\n\n" * 20 + "word " * 300
+    chunks = list(chunk_text(text, 200, 40))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert chunks[0].startswith("Para one")
+    assert chunks[-1].endswith("word")
+
+
+def test_chunks_end_on_paragraph_boundaries():
+    paragraph = "x" * 90
+    chunks = list(chunk_text(f"{paragraph}\n\n{paragraph}\n\n{paragraph}", 200, 40))
+    assert chunks[0] == f"{paragraph}\n\n{paragraph}"
+
+
+def test_overlap_starts_on_a_word_boundary():
+    words = " ".join(f"w{i:03d}" for i in range(100))
+    chunks = list(chunk_text(words, 100, 30))
+    for previous, chunk in zip(chunks, chunks[1:]):
+        first_word = chunk.split()[0]
+        assert first_word in previous.split()
+
+
+def test_text_without_separators_is_cut_hard():
+    # With no space in the overlap either, the next chunk starts at the cut rather than mid-word
+    chunks = list(chunk_text("x" * 450, 200, 40))
+    assert [len(chunk) for chunk in chunks] == [200, 200, 50]
+
+
+def test_overlap_must_be_smaller_than_the_chunk_size():
+    with pytest.raises(ValueError):
+        list(chunk_text("text", 100, 100))
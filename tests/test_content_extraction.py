@@ -0,0 +1,115 @@
+import io
+import zipfile
+from types import SimpleNamespace
+import httplib2
+import pytest
+from content_extraction import ExtractionLimitError, _docx_text, extract_contents, extract_file_content
+from drive_source import drive_file_payload, index_settings
+from qdrant_store import FILE_CHANGED, drive_point_id, file_index_from_columns, index_columns
+
+DOCUMENT_XML = (
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '<w:p><w:r><w:t>First paragraph</w:t></w:r><w:r><w:t xml:space="preserve"> continues.</w:t></w:r></w:p>'
+    '<w:p><w:r><w:t>Second paragraph.</w:t></w:r></w:p>'
+    '</w:body></w:document>'
+)
+
+
+def docx_bytes(document_xml=DOCUMENT_XML):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('word/document.xml', document_xml)
+    buffer.seek(0)
+    return buffer
+
+
+class FakeHttp:
+    """Serves ranged GETs of fixed bytes, like a media download endpoint"""
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = 0
+
+    def request(self, uri, method="GET", headers=None, **kwargs):
+        self.requests += 1
+        first, last = (int(n) for n in headers["range"].split("=")[1].split("-"))
+        content = self.data[first:last + 1]
+        response = httplib2.Response({"status": 206, "content-range": f"bytes {first}-{last}/{len(self.data)}"})
+        return response, content
+
+
+class FakeFiles:
+    def __init__(self, data):
+        self.http = FakeHttp(data)
+
+    def get_media(self, fileId):
+        return SimpleNamespace(uri=f"https://drive.example/{fileId}", headers={}, http=self.http)
+
+    export_media = get_media
+
+
+class FakeService:
+    def __init__(self, data):
+        self.fake_files = FakeFiles(data)
+
+    def files(self):
+        return self.fake_files
+
+
+def text_file(file_id="f1", size=None):
+    return {"id": file_id, "name": f"{file_id}.txt", "mimeType": "text/plain", "size": size, "version": "1"}
+
+
+def test_docx_paragraphs_are_kept_on_their_own_lines():
+    assert _docx_text(docx_bytes(), 1000) == "First paragraph continues.\nSecond paragraph."
+
+
+def test_docx_text_stops_at_max_chars():
+    assert _docx_text(docx_bytes(), 10) == "First para"
+
+
+def test_text_content_is_downloaded():
+    service = FakeService(b"hello from drive")
+    assert extract_file_content(service, text_file()) == "hello from drive"
+
+
+def test_listed_size_over_the_limit_skips_the_download():
+    service = FakeService(b"x" * 100)
+    assert extract_file_content(service, text_file(size="100"), max_bytes=10) is None
+    assert service.fake_files.http.requests == 0
+
+
+def test_download_over_the_byte_limit_fails():
+    with pytest.raises(ExtractionLimitError):
+        extract_file_content(FakeService(b"x" * 100), text_file(), max_bytes=10)
+
+
+def test_download_over_the_time_limit_fails():
+    with pytest.raises(ExtractionLimitError):
+        extract_file_content(FakeService(b"x" * 100), text_file(), timeout=-1)
+
+
+def test_unsupported_files_have_no_content():
+    file = dict(text_file(), name="photo.jpg", mimeType="image/jpeg")
+    assert extract_file_content(FakeService(b"x"), file) is None
+
+
+def test_failed_extraction_is_retried_on_the_next_sync():
+    settings = index_settings("fake/8", extract_content=True)
+    files = list(extract_contents([text_file()], lambda: FakeService(b"x" * 100), workers=1, max_bytes=10))
+    assert "content" not in files[0]
+    assert files[0]["content_error"]
+
+    stored = drive_file_payload(files[0], settings)
+    assert stored["index_settings"] == index_settings("fake/8", extract_content=False)
+    index = file_index_from_columns([index_columns([SimpleNamespace(id=drive_point_id("f1"), payload=stored)])])
+    assert index.classify(text_file(), settings) == FILE_CHANGED
+
+
+def test_extracted_and_unsupported_files_keep_the_content_settings():
+    settings = index_settings("fake/8", extract_content=True)
+    image = dict(text_file("f2"), name="photo.jpg", mimeType="image/jpeg")
+    files = list(extract_contents([text_file(), image], lambda: FakeService(b"some text"), workers=1))
+    assert files[0]["content"] == "some text"
+    assert "content" not in files[1]
+    assert all(drive_file_payload(file, settings)["index_settings"] == settings for file in files)
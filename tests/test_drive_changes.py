@@ -0,0 +1,64 @@
+from drive_source import DriveChanges
+
+
+class FakeChanges:
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def list(self, pageToken, **kwargs):
+        self.requested.append(pageToken)
+        return FakeRequest(self.pages[pageToken])
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeService:
+    def __init__(self, pages):
+        self.fake_changes = FakeChanges(pages)
+
+    def changes(self):
+        return self.fake_changes
+
+
+def file_change(file_id, **fields):
+    return {"changeType": "file", "fileId": file_id, "file": dict({"id": file_id, "name": file_id}, **fields)}
+
+
+def test_yields_changed_files_and_collects_removed_and_trashed():
+    service = FakeService({
+        "t1": {
+            "nextPageToken": "t2",
+            "changes": [
+                file_change("kept"),
+                {"changeType": "file", "fileId": "removed", "removed": True},
+                file_change("trashed", trashed=True),
+            ],
+        },
+        "t2": {
+            "newStartPageToken": "t3",
+            "changes": [
+                {"changeType": "drive", "driveId": "shared"},
+                {"changeType": "file", "fileId": "no-file"},
+                file_change("edited"),
+            ],
+        },
+    })
+    changes = DriveChanges(service, "t1")
+    assert [file["id"] for file in changes] == ["kept", "edited"]
+    assert changes.removed_file_ids == ["removed", "trashed", "no-file"]
+    assert changes.new_start_page_token == "t3"
+    assert service.fake_changes.requested == ["t1", "t2"]
+
+
+def test_no_changes_still_returns_the_next_token():
+    changes = DriveChanges(FakeService({"t1": {"newStartPageToken": "t1", "changes": []}}), "t1")
+    assert list(changes) == []
+    assert changes.removed_file_ids == []
+    assert changes.new_start_page_token == "t1"
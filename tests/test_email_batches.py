@@ -0,0 +1,40 @@
+from Emailimport import build_email_batches
+from chunking import chunk_text
+from embeddings import FakeBackend
+
+
+def parsed_email(uid, text):
+    return {"message_id": f"<{uid}@example.com>", "subject": f"s{uid}", "from": "a@example.com",
+            "date": None, "text": text}
+
+
+def batch_uids(batch):
+    return [payload["uid"] for payload in batch.payloads]
+
+
+def test_batches_close_at_email_boundaries_by_point_count():
+    long_text = "Some words in a sentence. " * 2000
+    emails = [(1, parsed_email(1, "short one")), (2, parsed_email(2, long_text)), (3, parsed_email(3, "short two")),
+              (4, parsed_email(4, "short three")), (5, parsed_email(5, "short four"))]
+    long_chunks = len(list(chunk_text(long_text)))
+    assert long_chunks > 10
+
+    batches = list(build_email_batches(iter(emails), FakeBackend(8), lambda uid: f"key/{uid}", batch_size=3))
+
+    # The long email is never split, and a batch closes once it reaches 3 points
+    assert [sorted(set(batch_uids(batch))) for batch in batches] == [[1, 2], [3, 4, 5]]
+    assert len(batches[0].ids) == 1 + long_chunks
+    assert [payload["chunk_index"] for payload in batches[0].payloads] == list(range(1)) + list(range(long_chunks))
+    assert all(len(batch.vectors) == len(batch.ids) == len(batch.payloads) for batch in batches)
+
+
+def test_short_emails_fill_batches_up_to_the_point_count():
+    emails = [(uid, parsed_email(uid, f"email {uid}")) for uid in range(1, 8)]
+    batches = list(build_email_batches(iter(emails), FakeBackend(8), lambda uid: f"key/{uid}", batch_size=3))
+    assert [batch_uids(batch) for batch in batches] == [[1, 2, 3], [4, 5, 6], [7]]
+
+
+def test_emails_without_text_add_no_points():
+    emails = [(1, parsed_email(1, "")), (2, parsed_email(2, "hello"))]
+    batches = list(build_email_batches(iter(emails), FakeBackend(8), lambda uid: f"key/{uid}"))
+    assert [batch_uids(batch) for batch in batches] == [[2]]
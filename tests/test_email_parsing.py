@@ -0,0 +1,51 @@
+from email_parsing import html_to_text, parse_email, parse_emails
+
+
+def test_declared_charset_and_encoded_headers_are_decoded():
+    raw = (b"Message-ID: <latin@example.com>\nSubject: =?iso-8859-1?q?caf=E9?=\n"
+           b"Content-Type: text/plain; charset=iso-8859-1\n\nun caf\xe9 tr\xe8s bon")
+    parsed = parse_email(raw)
+    assert parsed["message_id"] == "<latin@example.com>"
+    assert parsed["subject"] == "café"
+    assert parsed["text"] == "Subject: café\nBody: un café très bon"
+
+
+def test_unknown_charset_falls_back_to_utf8_without_raising():
+    raw = b"Subject: b\nContent-Type: text/plain; charset=x-unknown\n\n\xff\xfe ok"
+    assert parse_email(raw)["text"] == "Subject: b\nBody: �� ok"
+
+
+def test_html_body_drops_scripts_and_styles():
+    raw = (b"Subject: h\nContent-Type: text/html; charset=utf-8\n\n"
+           b"<html><head><style>p{}</style></head><body><p>Hello <b>world</b></p>"
+           b"<script>x()</script><div>bye &amp; thanks</div></body></html>")
+    assert parse_email(raw)["text"] == "Subject: h\nBody: Hello world\n\nbye & thanks"
+
+
+def test_html_part_is_used_when_there_is_no_plain_text():
+    raw = (b'Subject: m\nContent-Type: multipart/alternative; boundary="B"\n\n'
+           b"--B\nContent-Type: text/plain\n\n \n--B\nContent-Type: text/html\n\n<p>only html</p>\n--B--\n")
+    assert parse_email(raw)["text"] == "Subject: m\nBody: only html"
+
+
+def test_attachments_are_not_embedded():
+    raw = (b'Subject: a\nContent-Type: multipart/mixed; boundary="B"\n\n'
+           b"--B\nContent-Type: text/plain\n\nbody\n--B\nContent-Type: text/plain\n"
+           b'Content-Disposition: attachment; filename="notes.txt"\n\nattached\n--B--\n')
+    assert parse_email(raw)["text"] == "Subject: a\nBody: body"
+
+
+def test_text_is_cut_to_max_chars():
+    raw = b"Subject: x\n\n" + b"a" * 1000
+    assert len(parse_email(raw, max_chars=50)["text"]) == 50
+
+
+def test_html_to_text_collapses_whitespace():
+    assert html_to_text("<div>a \t  b</div>\n\n\n<p>c</p>") == "a b\n\nc"
+
+
+def test_parse_emails_keeps_order_on_a_process_pool():
+    raw_emails = ((uid, f"Subject: s{uid}\n\nbody {uid}".encode()) for uid in range(1, 40))
+    parsed = list(parse_emails(raw_emails, workers=2, chunk_size=4))
+    assert [uid for uid, _ in parsed] == list(range(1, 40))
+    assert parsed[5][1]["text"] == "Subject: s6\nBody: body 6"
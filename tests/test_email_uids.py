@@ -0,0 +1,107 @@
+import Emailimport
+from Emailimport import get_emails, iter_mailbox_messages, parse_fetch_response, sync_state_key, to_message_set
+
+
+class FakeIMAP:
+    """Serves UID SEARCH and UID FETCH for a fixed set of messages"""
+
+    def __init__(self, uids, uid_validity=1):
+        self.messages = {uid: f"Subject: {uid}\n\nbody {uid}".encode() for uid in uids}
+        self.uid_validity = uid_validity
+        self.fetched = []
+
+    def login(self, user, password):
+        pass
+
+    def select(self, label, readonly=False):
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        return code, [str(self.uid_validity).encode()]
+
+    def logout(self):
+        pass
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            low = int(args[1].split()[1].split(':')[0])
+            # Like real servers, n:* matches the highest UID even when it is below n
+            hits = [uid for uid in self.messages if uid >= low] or [max(self.messages)]
+            return "OK", [b" ".join(str(uid).encode() for uid in hits)]
+        message_set, _ = args
+        self.fetched.append(message_set)
+        response = []
+        for part in message_set.split(','):
+            first, _, last = part.partition(':')
+            for uid in range(int(first), int(last or first) + 1):
+                if uid in self.messages:
+                    raw = self.messages[uid]
+                    response += [(f"{uid} (UID {uid} BODY[] {{{len(raw)}}}".encode(), raw), b")"]
+        return "OK", response
+
+
+def test_to_message_set_compresses_runs():
+    assert to_message_set([b"7", b"1", b"3", b"2"]) == "1:3,7"
+    assert to_message_set(["5"]) == "5"
+    assert to_message_set([1, 2, 4, 5, 6, 9]) == "1:2,4:6,9"
+
+
+def test_parse_fetch_response_reads_uid_from_either_fragment():
+    msg_data = [(b"1 (BODY[] {3}", b"abc"), b" UID 7)", (b"2 (UID 9 BODY[] {2}", b"de"), b")"]
+    assert parse_fetch_response(msg_data) == [(7, b"abc"), (9, b"de")]
+
+
+def test_messages_are_fetched_in_ranged_chunks():
+    mail = FakeIMAP([1, 2, 3, 4, 5, 6, 7, 9, 10])
+    messages = list(iter_mailbox_messages(mail, fetch_chunk_size=4))
+    assert [uid for uid, _ in messages] == [1, 2, 3, 4, 5, 6, 7, 9, 10]
+    assert messages[0][1] == mail.messages[1]
+    assert mail.fetched == ["1:4", "5:7,9", "10"]
+
+
+def test_only_messages_above_since_uid_are_fetched():
+    mail = FakeIMAP([3, 5, 8, 9])
+    assert [uid for uid, _ in iter_mailbox_messages(mail, since_uid=5, fetch_chunk_size=1)] == [8, 9]
+    assert mail.fetched == ["8", "9"]
+
+
+def test_nothing_is_fetched_past_the_highest_uid():
+    mail = FakeIMAP([3, 5])
+    assert list(iter_mailbox_messages(mail, since_uid=5)) == []
+    assert mail.fetched == []
+
+
+def test_resume_from_the_stored_uid(monkeypatch):
+    mail = FakeIMAP([1, 2, 3, 4], uid_validity=10)
+    monkeypatch.setattr(Emailimport.imaplib, "IMAP4_SSL", lambda server: mail)
+    key = sync_state_key("me@example.com", "INBOX")
+    sync_state = {key: {"uidvalidity": 10, "last_uid": 2, "settings": "fake/8"}}
+    uids = [uid for uid, _ in get_emails(
+        "imap.example.com", "me@example.com", "pw", sync_state=sync_state, settings="fake/8"
+    )]
+    assert uids == [3, 4]
+    assert sync_state[key] == {"uidvalidity": 10, "last_uid": 2, "settings": "fake/8"}
+
+
+def test_changed_uidvalidity_rescans_the_mailbox(monkeypatch):
+    mail = FakeIMAP([1, 2, 3], uid_validity=11)
+    monkeypatch.setattr(Emailimport.imaplib, "IMAP4_SSL", lambda server: mail)
+    key = sync_state_key("me@example.com", "INBOX")
+    sync_state = {key: {"uidvalidity": 10, "last_uid": 2, "settings": "fake/8"}}
+    uids = [uid for uid, _ in get_emails(
+        "imap.example.com", "me@example.com", "pw", sync_state=sync_state, settings="fake/8"
+    )]
+    assert uids == [1, 2, 3]
+    assert sync_state[key] == {"uidvalidity": 11, "last_uid": 0, "settings": "fake/8"}
+
+
+def test_new_embedding_settings_re_embed_the_mailbox(monkeypatch):
+    mail = FakeIMAP([1, 2, 3], uid_validity=10)
+    monkeypatch.setattr(Emailimport.imaplib, "IMAP4_SSL", lambda server: mail)
+    key = sync_state_key("me@example.com", "INBOX")
+    sync_state = {key: {"uidvalidity": 10, "last_uid": 3, "settings": "fake/8"}}
+    uids = [uid for uid, _ in get_emails(
+        "imap.example.com", "me@example.com", "pw", sync_state=sync_state, settings="other/8"
+    )]
+    assert uids == [1, 2, 3]
+    assert sync_state[key] == {"uidvalidity": 10, "last_uid": 0, "settings": "other/8"}
@@ -0,0 +1,49 @@
+import itertools
+from types import SimpleNamespace
+import numpy as np
+import embedding_cache
+from embedding_cache import ROW_OVERHEAD_BYTES, EmbeddingCache, content_hash
+
+SIZE = 8
+ROW_BYTES = SIZE * 4 + ROW_OVERHEAD_BYTES
+
+
+def vector(i):
+    return np.full(SIZE, i, dtype=np.float32)
+
+
+def test_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    keys = [content_hash("a"), content_hash("b")]
+    cache.put_many("model", keys, [vector(1), vector(2)])
+    found = cache.get_many("model", keys + [content_hash("c")])
+    assert set(found) == set(keys)
+    np.testing.assert_array_equal(found[keys[1]], vector(2))
+    assert cache.get_many("other-model", keys) == {}
+    cache.close()
+
+
+def test_least_recently_used_rows_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(embedding_cache, "time", SimpleNamespace(time=lambda: next(clock)))
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_bytes=5 * ROW_BYTES)
+    keys = [content_hash(f"text {i}") for i in range(6)]
+    for i, key in enumerate(keys[:5]):
+        cache.put_many("model", [key], [vector(i)])
+    # Reading the oldest row makes it the most recently used one
+    cache.get_many("model", [keys[0]])
+    cache.put_many("model", [keys[5]], [vector(5)])
+
+    # Over the cap, the cache is trimmed to 90% of it: the two least recently used rows go
+    remaining = cache.get_many("model", keys)
+    assert set(remaining) == {keys[0], keys[3], keys[4], keys[5]}
+    assert cache.size_bytes <= cache.max_bytes
+    cache.close()
+
+
+def test_size_is_recounted_on_open(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = EmbeddingCache(path)
+    cache.put_many("model", [content_hash("a"), content_hash("b")], [vector(1), vector(2)])
+    cache.close()
+    assert EmbeddingCache(path).size_bytes == 2 * ROW_BYTES
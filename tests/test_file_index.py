@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+from drive_source import drive_chunk_payload, drive_file_payload
+from qdrant_store import (
+    FILE_CHANGED, FILE_NEW, FILE_REWRITTEN, FILE_UNCHANGED, RewriteIndex, drive_point_id, file_index_from_columns,
+    index_columns
+)
+
+SETTINGS = "fake/8;name;chunks=1000/150"
+
+
+def drive_file(file_id, version="1"):
+    return {"id": file_id, "name": f"{file_id}.txt", "md5Checksum": f"md5-{version}", "version": version,
+            "modifiedTime": "2024-01-01T00:00:00Z"}
+
+
+def stored_points(files, settings=SETTINGS):
+    return [SimpleNamespace(id=drive_point_id(f["id"]), payload=drive_file_payload(f, settings)) for f in files]
+
+
+def stored_index(files, settings=SETTINGS, extra_points=()):
+    return file_index_from_columns([index_columns(stored_points(files, settings) + list(extra_points))])
+
+
+def test_stored_files_are_found_and_others_are_new():
+    index = stored_index([drive_file("a"), drive_file("b")])
+    assert len(index) == 2
+    assert index.classify(drive_file("a"), SETTINGS) == FILE_UNCHANGED
+    assert index.classify(drive_file("c"), SETTINGS) == FILE_NEW
+
+
+def test_new_version_or_checksum_counts_as_changed():
+    index = stored_index([drive_file("a"), drive_file("b")])
+    assert index.classify(drive_file("a", version="2"), SETTINGS) == FILE_CHANGED
+    edited = dict(drive_file("b"), md5Checksum="md5-other")
+    assert index.classify(edited, SETTINGS) == FILE_CHANGED
+    # Changed files are matched, so their old points are replaced rather than deleted
+    assert index.deleted_count() == 0
+
+
+def test_other_index_settings_count_as_changed():
+    index = stored_index([drive_file("a"), drive_file("b")])
+    assert index.classify(drive_file("a"), "fake/8;content|name;chunks=1000/150") == FILE_CHANGED
+    assert index.classify(drive_file("b"), "other/8;name;chunks=1000/150") == FILE_CHANGED
+
+
+def test_index_merges_pages():
+    pages = [[drive_file("a"), drive_file("b")], [drive_file("c")]]
+    index = file_index_from_columns([index_columns(stored_points(page)) for page in pages])
+    assert len(index) == 3
+    assert all(index.find(drive_point_id(file_id)) >= 0 for file_id in "abc")
+    assert index.find(drive_point_id("d")) == -1
+
+
+def test_unmatched_points_are_deleted():
+    index = stored_index([drive_file("a"), drive_file("b"), drive_file("c")])
+    index.classify(drive_file("a"), SETTINGS)
+    index.classify(drive_file("c"), SETTINGS)
+    index.classify(drive_file("d"), SETTINGS)
+    assert index.deleted_count() == 1
+    assert index.deleted_point_ids() == [drive_point_id("b")]
+
+
+def test_later_chunks_and_integer_ids_are_not_indexed():
+    file = drive_file("a")
+    extra = [
+        SimpleNamespace(id=drive_point_id("a#1"), payload=drive_chunk_payload(file, 1, "more", SETTINGS)),
+        SimpleNamespace(id=7, payload={}),
+    ]
+    index = stored_index([file], extra_points=extra)
+    assert len(index) == 1
+    index.classify(file, SETTINGS)
+    assert index.deleted_count() == 0
+
+
+def test_empty_index_treats_every_file_as_new():
+    index = file_index_from_columns([])
+    assert index.classify(drive_file("a")) == FILE_NEW
+    assert index.deleted_point_ids() == []
+
+
+def test_rewrite_index_rewrites_every_file_and_deletes_nothing():
+    index = RewriteIndex()
+    assert index.classify(drive_file("a"), SETTINGS) == FILE_REWRITTEN
+    assert index.deleted_count() == 0
+    assert index.deleted_point_ids() == []
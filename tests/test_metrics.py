@@ -0,0 +1,51 @@
+import asyncio
+from qdrant_client import AsyncQdrantClient
+import async_qdrant_store
+import metrics
+from metrics import STAGE_SECONDS, Counter, Histogram, render_metrics
+
+
+def stage_count(stage):
+    return STAGE_SECONDS.values.get((stage,), [None, 0.0, 0])[2]
+
+
+def test_histogram_buckets_are_cumulative(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    histogram = Histogram("test_seconds", "Test latency", ("stage",), buckets=(1, 0.1, 10))
+    for value in (0.05, 0.5, 0.7, 20):
+        histogram.observe(value, stage="embed")
+
+    assert render_metrics().splitlines() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="embed",le="0.1"} 1',
+        'test_seconds_bucket{stage="embed",le="1"} 3',
+        'test_seconds_bucket{stage="embed",le="10"} 3',
+        'test_seconds_bucket{stage="embed",le="+Inf"} 4',
+        'test_seconds_sum{stage="embed"} 21.25',
+        'test_seconds_count{stage="embed"} 4',
+    ]
+
+
+def test_label_values_are_escaped_and_unlabelled_metrics_start_at_zero(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    total = Counter("test_total", "Test counter")
+    by_kind = Counter("test_kind_total", "Test counter by kind", ("kind",))
+    by_kind.inc(2, kind='say "hi"\\\n')
+
+    samples = [line for line in render_metrics().splitlines() if not line.startswith("#")]
+    assert samples == ["test_total 0", 'test_kind_total{kind="say \\"hi\\"\\\\\\n"} 2']
+    assert total in metrics.REGISTRY
+
+
+def test_scanning_the_stored_files_is_observed_as_fetch_existing():
+    async def scenario():
+        qdrant = AsyncQdrantClient(":memory:")
+        await async_qdrant_store.prepare_collection(qdrant, "docs", 8)
+        before = stage_count("fetch_existing")
+        _, existing_files = await async_qdrant_store.prepare_collection(qdrant, "docs", 8)
+        return existing_files, stage_count("fetch_existing") - before
+
+    existing_files, observed = asyncio.run(scenario())
+    assert len(existing_files) == 0
+    assert observed == 1
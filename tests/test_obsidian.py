@@ -0,0 +1,91 @@
+import os
+import pytest
+from qdrant_client import QdrantClient
+from Obsidianimport import sync_vault
+from embeddings import FakeBackend
+from obsidian_source import diff_vault, parse_note
+
+
+def write_note(vault, path, text):
+    full_path = os.path.join(vault, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return full_path
+
+
+def test_diff_vault_reports_new_edited_and_removed_notes(tmp_path):
+    vault = str(tmp_path)
+    write_note(vault, "a.md", "alpha")
+    write_note(vault, "dir/b.md", "beta")
+    write_note(vault, ".obsidian/workspace.md", "hidden")
+    write_note(vault, "image.png", "not a note")
+
+    changed, removed, manifest = diff_vault(vault, {})
+    assert sorted(path for path, _ in changed) == ["a.md", "dir/b.md"]
+    assert removed == []
+    assert sorted(manifest) == ["a.md", "dir/b.md"]
+
+    # Touched without a content change, edited, and deleted
+    a_path = os.path.join(vault, "a.md")
+    os.utime(a_path, ns=(0, os.stat(a_path).st_mtime_ns + 10 ** 9))
+    write_note(vault, "c.md", "gamma")
+    os.remove(os.path.join(vault, "dir", "b.md"))
+    changed, removed, new_manifest = diff_vault(vault, manifest)
+    assert [path for path, _ in changed] == ["c.md"]
+    assert removed == ["dir/b.md"]
+    assert new_manifest["a.md"][2] == manifest["a.md"][2]
+
+
+def test_parse_note_reads_front_matter_tags_and_links():
+    raw = (
+        "---\ntitle: Project plan\ntags: [work, planning]\naliases:\n  - Plan\ndate: 2024-01-02\n---\n"
+        "See [[Roadmap|the roadmap]] and ![[diagram.png]] for #status/active.\n"
+        "```\n#not-a-tag [[not-a-link]]\n```\nIssue #42 is open."
+    ).encode('utf-8')
+    note = parse_note("notes/plan.md", raw)
+    assert note["title"] == "Project plan"
+    assert note["aliases"] == ["Plan"]
+    assert note["tags"] == ["work", "planning", "status/active"]
+    assert note["links"] == ["Roadmap", "diagram.png"]
+    assert note["front_matter"]["date"] == "2024-01-02"
+    assert note["body"].startswith("See [[Roadmap")
+
+
+def test_parse_note_without_front_matter_uses_the_file_name():
+    note = parse_note("daily/2024-01-02.md", "﻿Just text.".encode('utf-8'))
+    assert note["title"] == "2024-01-02"
+    assert note["front_matter"] == {}
+    assert note["body"] == "Just text."
+
+
+class OtherModel(FakeBackend):
+    name = "other"
+
+    def embed_batch(self, texts):
+        return super().embed_batch([f"other model: {text}" for text in texts])
+
+
+def stored_models(client):
+    points, _ = client.scroll("notes", limit=100, with_payload=True, with_vectors=True)
+    return {point.payload["file_id"]: point.vector for point in points}
+
+
+def test_sync_vault_re_embeds_every_note_for_a_new_model(tmp_path):
+    vault = str(tmp_path / "vault")
+    manifest_file = str(tmp_path / "manifest.json")
+    write_note(vault, "a.md", "alpha")
+    write_note(vault, "b.md", "beta")
+    client = QdrantClient(":memory:")
+
+    assert sync_vault(vault, client, "notes", FakeBackend(8), manifest_file)[:2] == (2, 0)
+    assert sync_vault(vault, client, "notes", FakeBackend(8), manifest_file) == (0, 0, 0)
+    before = stored_models(client)
+
+    os.remove(os.path.join(vault, "b.md"))
+    changed, removed, upserted = sync_vault(vault, client, "notes", OtherModel(8), manifest_file)
+    assert (changed, removed, upserted) == (1, 1, 1)
+    after = stored_models(client)
+    assert sorted(after) == ["a.md"]
+    assert after["a.md"] != pytest.approx(before["a.md"])
+    assert sync_vault(vault, client, "notes", OtherModel(8), manifest_file) == (0, 0, 0)
@@ -0,0 +1,53 @@
+import asyncio
+from sync_jobs import JOB_FAILED, JOB_SUCCEEDED, SyncJobQueue
+
+
+def test_one_job_per_collection_at_a_time():
+    async def scenario():
+        release = asyncio.Event()
+        running = []
+
+        async def run_job(job):
+            running.append(job.collection_name)
+            await release.wait()
+            return {"collection": job.collection_name}
+
+        queue = SyncJobQueue(run_job, workers=2)
+        first = queue.submit("docs")
+        assert queue.submit("docs") is first
+        other = queue.submit("notes")
+        assert other is not first
+
+        await asyncio.sleep(0)
+        assert sorted(running) == ["docs", "notes"]
+        assert queue.submit("docs") is first
+
+        release.set()
+        await queue.wait(first.id)
+        await queue.wait(other.id)
+        assert first.status == JOB_SUCCEEDED
+        assert first.result == {"collection": "docs"}
+
+        again = queue.submit("docs")
+        assert again is not first
+        await queue.wait(again.id)
+        await queue.stop()
+        return running
+
+    assert asyncio.run(scenario()) == ["docs", "notes", "docs"]
+
+
+def test_failed_job_frees_its_collection():
+    async def scenario():
+        async def run_job(job):
+            raise RuntimeError("boom")
+
+        queue = SyncJobQueue(run_job, workers=1)
+        job = await queue.wait(queue.submit("docs").id)
+        assert job.status == JOB_FAILED
+        assert job.error == "boom"
+        assert "docs" not in queue.active
+        assert queue.submit("docs") is not job
+        await queue.stop()
+
+    asyncio.run(scenario())
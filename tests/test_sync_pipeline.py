@@ -0,0 +1,106 @@
+import json
+from collections import Counter
+from types import SimpleNamespace
+from qdrant_client import QdrantClient
+from embeddings import FakeBackend
+from qdrant_store import (
+    DEDUP_LOOKUP, DEDUP_NONE, DEDUP_SCAN, FILE_CHANGED, FILE_DELETED, FILE_NEW, FILE_REWRITTEN, FILE_UNCHANGED,
+    delete_indexed_files, drive_point_id, finish_sync, prepare_collection, sync_drive_files
+)
+
+
+def drive_file(file_id, version="1"):
+    return {"id": file_id, "name": f"{file_id}.txt", "md5Checksum": f"md5-{version}", "version": version,
+            "modifiedTime": "2024-01-01T00:00:00Z"}
+
+
+def long_file(file_id):
+    """A file whose content spans several chunks"""
+    return dict(drive_file(file_id), content="Some words in a sentence. " * 200)
+
+
+def run_sync(qdrant, files, dedup_mode=DEDUP_SCAN, embedder=None):
+    """One full sync of files into the docs collection; returns the status counts"""
+    _, existing_files = prepare_collection(qdrant, "docs", 8, dedup_mode)
+    counts = Counter()
+    sync_drive_files(qdrant, "docs", iter(files), existing_files, counts, embedder or FakeBackend(8))
+    finish_sync(qdrant, "docs", existing_files, None, counts)
+    return counts
+
+
+def stored_file_ids(qdrant):
+    points, _ = qdrant.scroll("docs", limit=100, with_payload=["file_id"])
+    return sorted(point.payload["file_id"] for point in points)
+
+
+def test_scan_mode_skips_stored_files_and_deletes_missing_ones():
+    qdrant = QdrantClient(":memory:")
+    assert run_sync(qdrant, [drive_file("a"), drive_file("b")])[FILE_NEW] == 2
+
+    counts = run_sync(qdrant, [drive_file("a"), drive_file("c")])
+    assert (counts[FILE_NEW], counts[FILE_UNCHANGED], counts[FILE_DELETED]) == (1, 1, 1)
+    assert stored_file_ids(qdrant) == ["a", "c"]
+    assert qdrant.retrieve("docs", [drive_point_id("b")]) == []
+
+
+def test_lookup_mode_checks_only_the_listed_files():
+    qdrant = QdrantClient(":memory:")
+    run_sync(qdrant, [drive_file("a"), drive_file("b"), drive_file("c")], DEDUP_LOOKUP)
+    assert prepare_collection(qdrant, "docs", 8, DEDUP_LOOKUP) == (None, None)
+
+    counts = run_sync(qdrant, [drive_file("a"), drive_file("b", version="2"), drive_file("d")], DEDUP_LOOKUP)
+    assert (counts[FILE_UNCHANGED], counts[FILE_CHANGED], counts[FILE_NEW]) == (1, 1, 1)
+    # Deletions cannot be seen without the full index, so c is kept
+    assert counts[FILE_DELETED] == 0
+    assert stored_file_ids(qdrant) == ["a", "b", "c", "d"]
+
+
+def test_none_mode_rewrites_every_file_in_place():
+    qdrant = QdrantClient(":memory:")
+    run_sync(qdrant, [drive_file("a"), drive_file("b")], DEDUP_NONE)
+
+    counts = run_sync(qdrant, [drive_file("a"), drive_file("c")], DEDUP_NONE)
+    assert counts[FILE_REWRITTEN] == 2
+    assert counts[FILE_NEW] == counts[FILE_DELETED] == 0
+    # Deterministic point IDs overwrite a rewritten file, and nothing is deleted
+    assert stored_file_ids(qdrant) == ["a", "b", "c"]
+    assert qdrant.count("docs").count == 3
+
+
+def test_deleting_an_indexed_file_removes_all_its_chunks():
+    qdrant = QdrantClient(":memory:")
+    run_sync(qdrant, [long_file("a"), drive_file("b")])
+    assert stored_file_ids(qdrant).count("a") > 1
+
+    assert delete_indexed_files(qdrant, "docs", [drive_point_id("a")]) == 1
+    assert stored_file_ids(qdrant) == ["b"]
+
+
+def test_full_sync_deletes_every_file_it_did_not_list(tmp_path):
+    qdrant = QdrantClient(":memory:")
+    run_sync(qdrant, [long_file("a"), drive_file("b")])
+    sync_state_file = tmp_path / "sync_state.json"
+
+    _, existing_files = prepare_collection(qdrant, "docs", 8)
+    counts = Counter()
+    sync_drive_files(qdrant, "docs", iter([drive_file("b")]), existing_files, counts, FakeBackend(8))
+    token = finish_sync(qdrant, "docs", existing_files, None, counts, "token-1", str(sync_state_file))
+
+    assert stored_file_ids(qdrant) == ["b"]
+    assert token == "token-1"
+    assert json.loads(sync_state_file.read_text()) == {"docs": "token-1"}
+
+
+def test_delta_sync_deletes_the_removed_files_and_saves_the_new_token(tmp_path):
+    qdrant = QdrantClient(":memory:")
+    run_sync(qdrant, [long_file("a"), drive_file("b"), drive_file("c")])
+    sync_state_file = tmp_path / "sync_state.json"
+    drive_changes = SimpleNamespace(removed_file_ids=["a", "c"], new_start_page_token="token-2")
+
+    counts = Counter()
+    token = finish_sync(qdrant, "docs", None, drive_changes, counts, "ignored", str(sync_state_file))
+
+    assert counts[FILE_DELETED] == 2
+    assert stored_file_ids(qdrant) == ["b"]
+    assert token == "token-2"
+    assert json.loads(sync_state_file.read_text()) == {"docs": "token-2"}
@@ -0,0 +1,95 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import tracing
+from tracing import NOOP_SPAN, JsonlExporter, configure_tracing, in_current_context, span, traced
+
+
+class CollectingExporter:
+    def __init__(self):
+        self.spans = []
+
+    def on_start(self, span):
+        pass
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def exporter():
+    previous = tracing._exporters
+    exporter = CollectingExporter()
+    configure_tracing(exporter)
+    yield exporter
+    configure_tracing(*previous)
+
+
+def by_name(exporter):
+    return {span.name: span for span in exporter.spans}
+
+
+def test_executor_threads_keep_the_parent_span(exporter):
+    def work(i):
+        with span("work", item=i):
+            pass
+
+    with span("sync") as parent:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(in_current_context(work), range(3)))
+            # Without the binding, a thread's span starts a trace of its own
+            executor.submit(work, 3).result()
+
+    children = [s for s in exporter.spans if s.name == "work"]
+    bound = [s for s in children if s.attributes["item"] < 3]
+    assert len(bound) == 3
+    assert all(s.parent_id == parent.span_id and s.trace_id == parent.trace_id for s in bound)
+    unbound = next(s for s in children if s.attributes["item"] == 3)
+    assert unbound.parent_id is None and unbound.trace_id != parent.trace_id
+
+
+def test_traced_functions_and_coroutines_nest_and_record_errors(exporter):
+    @traced()
+    def fails():
+        raise ValueError("bad input")
+
+    @traced("outer")
+    async def outer():
+        with pytest.raises(ValueError):
+            fails()
+
+    asyncio.run(outer())
+    spans = by_name(exporter)
+    inner = spans["test_traced_functions_and_coroutines_nest_and_record_errors.<locals>.fails"]
+    assert inner.parent_id == spans["outer"].span_id
+    assert inner.error == "ValueError: bad input"
+    assert spans["outer"].error is None
+    assert inner.duration_ms >= 0
+
+
+def test_spans_are_no_ops_while_tracing_is_off(monkeypatch):
+    monkeypatch.setattr(tracing, "_exporters", ())
+    assert span("anything", x=1) is NOOP_SPAN
+    assert in_current_context(len) is len
+
+
+def test_jsonl_exporter_writes_one_line_per_span(tmp_path):
+    previous = tracing._exporters
+    exporter = JsonlExporter(str(tmp_path / "traces.jsonl"))
+    configure_tracing(exporter)
+    try:
+        with span("sync", collection="docs"):
+            with span("embed", points=4):
+                pass
+    finally:
+        configure_tracing(*previous)
+
+    lines = [json.loads(line) for line in (tmp_path / "traces.jsonl").read_text().splitlines()]
+    assert [line["name"] for line in lines] == ["embed", "sync"]
+    assert lines[0]["parent_span_id"] == lines[1]["span_id"]
+    assert lines[1]["attributes"] == {"collection": "docs"}
+    assert lines[1]["status"] == "ok"
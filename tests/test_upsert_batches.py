@@ -0,0 +1,80 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from qdrant_client.http.models import Batch
+import qdrant_store
+from qdrant_store import UPSERT_RETRIES, upsert_batches
+
+
+def make_batch(n, size=2):
+    return Batch(ids=[f"00000000-0000-0000-0000-{n:06d}{i:06d}" for i in range(size)],
+                 vectors=[[0.0, 1.0]] * size, payloads=[{"batch": n}] * size)
+
+
+class FakeQdrant:
+    """Records upserts; fails a batch's first attempts and can hold uploads for a while"""
+
+    def __init__(self, failures=None, delays=None):
+        self.failures = dict(failures or {})
+        self.delays = delays or {}
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.running = 0
+        self.max_running = 0
+
+    def upsert(self, collection_name, points):
+        n = points.payloads[0]["batch"]
+        with self.lock:
+            self.attempts[n] = self.attempts.get(n, 0) + 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delays.get(n, 0.01))
+            with self.lock:
+                if self.failures.get(n, 0) > 0:
+                    self.failures[n] -= 1
+                    raise ConnectionError(f"batch {n} failed")
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # Only the retry backoff is skipped; the fake's uploads still take time
+    monkeypatch.setattr(qdrant_store, "time", SimpleNamespace(sleep=lambda seconds: None))
+
+
+def test_a_failed_batch_is_retried_on_its_own():
+    qdrant = FakeQdrant(failures={2: 2})
+    upserted = upsert_batches(qdrant, "docs", (make_batch(n) for n in range(5)), workers=2)
+    assert upserted == 10
+    assert qdrant.attempts == {0: 1, 1: 1, 2: 3, 3: 1, 4: 1}
+
+
+def test_a_batch_that_keeps_failing_fails_the_sync():
+    qdrant = FakeQdrant(failures={1: UPSERT_RETRIES + 1})
+    with pytest.raises(ConnectionError):
+        upsert_batches(qdrant, "docs", (make_batch(n) for n in range(3)), workers=2)
+    assert qdrant.attempts[1] == UPSERT_RETRIES + 1
+
+
+def test_in_flight_batches_are_bounded_and_stored_in_order():
+    # The first upload is the slowest, so later ones finish before it
+    qdrant = FakeQdrant(delays={0: 0.1})
+    produced, stored, lookahead = [], [], []
+
+    def batches():
+        for n in range(12):
+            produced.append(n)
+            yield make_batch(n)
+
+    def on_stored(batch):
+        stored.append(batch.payloads[0]["batch"])
+        lookahead.append(len(produced) - len(stored))
+
+    assert upsert_batches(qdrant, "docs", batches(), workers=3, on_stored=on_stored) == 24
+    assert stored == list(range(12))
+    assert 1 < qdrant.max_running <= 3
+    assert max(lookahead) <= 3
@@ -0,0 +1,271 @@
+# Nested spans for attributing latency inside a single sync or email import.
+# Tracing is off unless an exporter is configured; while it is off, span()
+# returns a shared no-op span and traced() calls straight through.
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+# Comma-separated exporters to enable at import: jsonl, logging, otel
+TRACE_EXPORTERS = os.getenv('TRACE_EXPORTERS', '')
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+
+logger = logging.getLogger(__name__)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_exporters = ()
+
+
+class Span:
+    """A timed operation with attributes; entering it makes it the parent of new spans"""
+
+    def __init__(self, name, attributes=None):
+        parent = _current_span.get()
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_ns = None
+        self.end_ns = None
+        self.error = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6 if self.end_ns else None
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        _notify('on_start', self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        _notify('export', self)
+        return False
+
+    def to_dict(self):
+        """OpenTelemetry-style fields, for the JSONL exporter"""
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": self.duration_ms,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span while tracing is off"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attributes):
+    """Context manager timing a block as a child of the current span"""
+    if not _exporters:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def current_span():
+    """The innermost open span, or the no-op span, to add attributes to"""
+    return (_current_span.get() if _exporters else None) or NOOP_SPAN
+
+
+def traced(name=None):
+    """Decorator running each call of a function or coroutine function in a span"""
+    def decorate(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _exporters:
+                    return await func(*args, **kwargs)
+                with Span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _exporters:
+                return func(*args, **kwargs)
+            with Span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def in_current_context(func):
+    """Bind func to the caller's current span, for running it on another thread.
+
+    Executor threads do not inherit context variables, so spans started
+    there would otherwise begin new traces.
+    """
+    if not _exporters:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def _notify(method, finished_span):
+    for exporter in _exporters:
+        try:
+            getattr(exporter, method)(finished_span)
+        except Exception as e:
+            logger.warning(f"Trace exporter {type(exporter).__name__} failed: {e}")
+
+
+class JsonlExporter:
+    """Append one JSON line per finished span to a file"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def on_start(self, span):
+        pass
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def shutdown(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class LoggingExporter:
+    """Log each finished span with its duration and attributes"""
+
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def on_start(self, span):
+        pass
+
+    def export(self, span):
+        status = f" error={span.error}" if span.error else ""
+        self.log.log(self.level, f"span {span.name} {span.duration_ms:.1f}ms {span.attributes}{status}")
+
+    def shutdown(self):
+        pass
+
+
+class OpenTelemetryExporter:
+    """Mirror spans into an OpenTelemetry tracer, so any OTel SDK exporter can ship them.
+
+    Needs the optional opentelemetry-api package; the tracer provider and
+    its exporters are set up by the application as usual.
+    """
+
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer("drive_to_qdrant")
+        self.lock = threading.Lock()
+        self.open_spans = {}
+
+    def on_start(self, span):
+        with self.lock:
+            parent = self.open_spans.get(span.parent_id)
+        context = self.trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self.tracer.start_span(span.name, context=context, start_time=span.start_ns)
+        with self.lock:
+            self.open_spans[span.span_id] = otel_span
+
+    def export(self, span):
+        with self.lock:
+            otel_span = self.open_spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        otel_span.set_attributes({key: _otel_value(value) for key, value in span.attributes.items()})
+        if span.error:
+            from opentelemetry.trace import Status, StatusCode
+            otel_span.set_status(Status(StatusCode.ERROR, span.error))
+        otel_span.end(end_time=span.end_ns)
+
+    def shutdown(self):
+        pass
+
+
+def _otel_value(value):
+    # OpenTelemetry attributes only take primitives and lists of them
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)) and all(isinstance(item, (str, bool, int, float)) for item in value):
+        return list(value)
+    return str(value)
+
+
+EXPORTERS = {
+    "jsonl": JsonlExporter,
+    "logging": LoggingExporter,
+    "otel": OpenTelemetryExporter,
+}
+
+
+def configure_tracing(*exporters):
+    """Send spans to the given exporters; with none, tracing is turned off"""
+    global _exporters
+    for exporter in _exporters:
+        if exporter not in exporters:
+            exporter.shutdown()
+    _exporters = tuple(exporters)
+
+
+def exporters_from_env(names=TRACE_EXPORTERS):
+    exporters = []
+    for name in filter(None, (name.strip().lower() for name in names.split(','))):
+        if name not in EXPORTERS:
+            raise ValueError(f"Unknown trace exporter {name!r}, expected one of {', '.join(EXPORTERS)}")
+        exporters.append(EXPORTERS[name]())
+    return exporters
+
+
+configure_tracing(*exporters_from_env())